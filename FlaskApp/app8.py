@@ -1,31 +1,191 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
 import pandas as pd
+import numpy as np
 import random
+import secrets
 import os
+import re
 import base64
 import json
 import subprocess
 import tempfile
 import time
-from threading import Thread
-from io import BytesIO
-from PIL import Image
-import math
+from threading import Thread, Lock, Event, Condition
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from PIL import Image, ImageOps
+import gzip
+import hashlib
+import sys
+import atexit
+import queue
+import logging
+import logging.handlers
+from functools import lru_cache
+
+# orjson сериализует JSON в C сразу в bytes; без него остается стандартный json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+class OrjsonProvider(JSONProvider):
+    """JSON-провайдер Flask на orjson: используется в jsonify и request.get_json"""
+    mimetype = 'application/json'
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=ORJSON_OPTIONS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=ORJSON_OPTIONS), mimetype=self.mimetype)
+
+# Логи пишет отдельный поток: обработчики запросов только кладут записи в очередь
+# и не ждут вывода в консоль
+LOG_QUEUE = queue.SimpleQueue()
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, logging.StreamHandler(sys.stdout))
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
+
+# Одинаковые сообщения чаще, чем раз в LOG_REPEAT_WINDOW секунд, не выводятся
+LOG_REPEAT_WINDOW = 30
+
+class RepeatedMessageFilter(logging.Filter):
+    """Пропускает повтор одного и того же сообщения не чаще раза в LOG_REPEAT_WINDOW секунд"""
+    
+    def __init__(self):
+        super().__init__()
+        self.last_seen = {}
+        self.lock = Lock()
+    
+    def filter(self, record):
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_seen.get(key, -LOG_REPEAT_WINDOW) < LOG_REPEAT_WINDOW:
+                return False
+            # Сообщения с уникальным текстом (номера задач, пути) не копим бесконечно
+            if len(self.last_seen) >= 1000:
+                self.last_seen = {k: t for k, t in self.last_seen.items() if now - t < LOG_REPEAT_WINDOW}
+            self.last_seen[key] = now
+        return True
+
+logger = logging.getLogger('crushai')
+logger.setLevel(logging.INFO)
+log_handler = logging.handlers.QueueHandler(LOG_QUEUE)
+log_handler.addFilter(RepeatedMessageFilter())
+logger.addHandler(log_handler)
+logger.propagate = False
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+def dumps_json_bytes(obj):
+    """Сериализует obj в JSON bytes для заранее собранных ответов; orjson пишет bytes сразу"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=ORJSON_OPTIONS)
+    return app.json.dumps(obj).encode('utf-8')
+
+# Запросы больше этого размера отклоняются с 413 до чтения тела.
+# Клиент принимает фото до 5 МБ, в base64 оно вырастает примерно на треть
+MAX_REQUEST_SIZE = 10 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE
 
 # Создаем папку для загруженных фото если её нет
 UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+# Страница приложения
+INDEX_HTML_PATH = os.path.join(app.static_folder, 'index.html')
+# Прочитанная страница: (время изменения файла, содержимое, ETag, сжатое gzip содержимое)
+INDEX_PAGE_CACHE = None
+
+# Текстовые ответы сжимаются gzip, если клиент это поддерживает
+COMPRESS_MIMETYPES = ('text/html', 'application/json')
+COMPRESS_MIN_SIZE = 500  # байт, меньшие ответы сжимать невыгодно
+COMPRESS_LEVEL = 5
+
+# Сжатие встроенного CSS страницы: комментарии, лишние пробелы и последняя ';' в блоке
+STYLE_BLOCK = re.compile(rb'(<style[^>]*>)(.*?)(</style>)', re.S)
+CSS_COMMENTS = re.compile(r'/\*.*?\*/', re.S)
+CSS_WHITESPACE = re.compile(r'\s+')
+CSS_PUNCTUATION_SPACES = re.compile(r'\s*([{};:,>])\s*')
+
+# Сколько секунд браузер может не перепроверять справочники (марки, демо-фото)
+CATALOG_MAX_AGE = 3600
 
 # Папка с демо-фотографиями
 DEMO_PHOTOS_FOLDER = 'static/demo_photos'
-if not os.path.exists(DEMO_PHOTOS_FOLDER):
-    os.makedirs(DEMO_PHOTOS_FOLDER)
+os.makedirs(DEMO_PHOTOS_FOLDER, exist_ok=True)
+
+# JIT-компиляция числового ядра расчета, если установлена numba
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Без numba функция выполняется как обычная NumPy-функция"""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+# pybase64 декодирует base64 SIMD-инструкциями; без него остается стандартный base64
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+def b64decode_to_bytes(data):
+    """Декодирует base64 (bytes, memoryview или ASCII-строку) в байты"""
+    if pybase64 is not None:
+        return pybase64.b64decode(data, validate=False)
+    return base64.b64decode(data)
+
+# Движок чтения Excel: calamine заметно быстрее openpyxl, если установлен
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None  # движок pandas по умолчанию (openpyxl)
+
+# Порция base64 при декодировании загруженного фото (кратна 4) и буфер записи
+BASE64_CHUNK_SIZE = 256 * 1024
+# Пробельные символы убираются до нарезки на порции, иначе переносы строк сдвигают границы групп по 4 символа
+BASE64_WHITESPACE = b' \t\r\n\x0b\x0c'
+PHOTO_WRITE_BUFFER_SIZE = 1 << 20
+
+# Максимальный размер фото для анализа: модели все равно уменьшают изображение,
+# а декодировать и хранить полноразмерные снимки с телефона дорого
+ANALYSIS_MAX_SIZE = (1024, 1024)
+ANALYSIS_JPEG_QUALITY = 85
 
 # Путь к стороннему скрипту анализа повреждений
 DAMAGE_ANALYSIS_SCRIPT = 'cvmain/test.py'
+DAMAGE_ANALYSIS_TIMEOUT = 120  # секунд
+
+# Анализ повреждений выполняется в этом же процессе: модели загружаются один раз.
+# Если модуль не импортируется, остается запуск скрипта отдельным процессом
+try:
+    from cvmain.test import analyze_batch as cv_analyze_batch, load_models as cv_load_models
+except Exception as e:
+    cv_analyze_batch = None
+    cv_load_models = None
+    logger.warning(f"⚠️ Модуль анализа повреждений недоступен, будет использован запуск скрипта: {e}")
+
+# Один поток для анализа: модели не используются из нескольких потоков одновременно
+CV_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='damage-analysis')
+
+# Фото, ожидающие анализа: поток анализа забирает их пакетом и прогоняет модели один раз
+CV_BATCH_QUEUE = queue.SimpleQueue()
+CV_BATCH_MAX_SIZE = 8
+# Сколько ждать остальные фото пакета после первого (секунд)
+CV_BATCH_WINDOW = 0.02
 
 # Глобальная переменная для отслеживания статуса парсинга
 PARSING_STATUS = {
@@ -33,109 +193,235 @@ PARSING_STATUS = {
     'last_completed': None,
     'current_task': None
 }
+# Статус читают обработчики запросов, а пишет поток парсинга
+PARSING_STATUS_LOCK = Lock()
+# Условие на том же замке: SSE-потоки ждут на нем изменения статуса
+PARSING_STATUS_CHANGED = Condition(PARSING_STATUS_LOCK)
+# Номер версии статуса, увеличивается при каждом изменении
+PARSING_STATUS_VERSION = 0
+# Готовый JSON статуса: пересобирается при изменении, а не на каждый опрос
+PARSING_STATUS_JSON = b''
+# Как часто отправлять keep-alive комментарий в SSE, если статус не меняется
+PARSING_STREAM_KEEPALIVE = 15
+# Каждый SSE-поток занимает поток сервера, поэтому поток живет ограниченное время
+# (секунд), после чего браузер переподключается через PARSING_STREAM_RETRY_MS
+PARSING_STREAM_LIFETIME = 60
+PARSING_STREAM_RETRY_MS = 5000
+# Сколько SSE-потоков держать одновременно; остальные клиенты получают 503 и
+# переподключаются позже, а потоки сервера остаются для обычных запросов
+PARSING_STREAM_MAX_CLIENTS = 8
+PARSING_STREAM_CLIENTS = 0
+PARSING_STREAM_CLIENTS_LOCK = Lock()
+# Парсинг идет в ограниченном пуле потоков; одновременные запросы одной марки и модели
+# ждут один и тот же парсинг: (марка, модель) -> Future
+PARSING_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='parser')
+PARSING_TASKS = {}
+PARSING_TASKS_LOCK = Lock()
+# Запись huh_result.xlsx и перенос цен в таблицу в памяти идут под одной блокировкой:
+# иначе два парсинга разных моделей перезаписывают строки друг друга в Excel
+PARSED_PRICES_LOCK = Lock()
+
+# Задачи анализа повреждений: job_id -> бренд, модель, путь к фото, этап и результат
+ANALYSIS_JOBS = {}
+ANALYSIS_JOBS_LOCK = Lock()
+# Сколько секунд хранить задачу, результат которой не забрали
+ANALYSIS_JOB_TTL = 3600
 
 # Глобальная переменная для данных Excel
 CAR_PRICES_DF = None
 
-# Базовые ставки за ремонт вмятин (руб/см²)
-BASE_DENT_REPAIR_RATES = {
-    'сталь': {
-        'легкий': 150,    # руб/см² за легкие вмятины
-        'средний': 250,   # руб/см² за средние вмятины  
-        'тяжелый': 400    # руб/см² за тяжелые вмятины
-    },
-    'алюминий': {
-        'легкий': 200,    # +33% к стали
-        'средний': 350,   # +40% к стали
-        'тяжелый': 550    # +37% к стали
-    },
-    'магниевый сплав': {
-        'легкий': 300,    # +100% к стали
-        'средний': 500,   # +100% к стали
-        'тяжелый': 800    # +100% к стали (чаще требуется замена)
-    },
-    'композит': {
-        'легкий': 400,    # сложный материал
-        'средний': 700,   # требует спецоборудования
-        'тяжелый': 1200   # обычно только замена
-    }
-}
+# Установлено, когда завершилась первая загрузка таблицы цен (успешно или нет)
+PRICES_LOADED = Event()
+PRICES_LOAD_TIMEOUT = 30  # секунд
 
-# Коэффициенты стоимости ремонта в зависимости от типа повреждения
-REPAIR_COST_MULTIPLIERS = {
-    'вмятина': {
-        'легкий': 0.3,   # Небольшая вмятина - легкий ремонт
-        'средний': 0.5,  # Средняя вмятина 
-        'тяжелый': 0.8   # Сильная вмятина, почти не ремонтируется
-    },
-    'царапина': {
-        'легкий': 0.2,   # Поверхностная царапина
-        'средний': 0.4,  # Глубокая царапина
-        'тяжелый': 0.7   # Очень глубокая царапина до металла
-    },
-    'разрыв': {
-        'легкий': 0.6,
-        'средний': 0.9,
-        'тяжелый': 1.2   # Разрыв обычно требует замены
-    }
-}
+# Текстовые колонки таблицы цен
+STRING_COLUMNS = ('марка', 'модель', 'деталь', 'площадь детали', 'материал детали', 'ссылка')
 
-# Множители сложности для разных материалов
-MATERIAL_COMPLEXITY_MULTIPLIERS = {
-    'сталь': 1.0,
-    'алюминий': 1.4,      # +40% к стоимости
-    'магниевый сплав': 2.0, # +100% к стоимости
-    'композит': 2.5,      # +150% к стоимости
-    'пластик': 0.8        # -20% к стоимости (легче ремонтировать)
-}
+# Колонки с небольшим числом повторяющихся значений, хранятся как category
+CATEGORY_COLUMNS = ('марка', 'модель', 'деталь', 'площадь детали', 'материал детали')
+
+# Индексы по данным Excel, строятся один раз при загрузке
+CAR_PARTS_INDEX = {}   # (марка, модель) -> срез строк в CAR_PRICES_DF
+MODELS_BY_BRAND = {}   # марка -> отсортированный список моделей
+BRANDS = []            # отсортированный список марок
+PART_ROWS_INDEX = {}   # (марка, модель) -> {нормализованное название детали: позиция строки}
+
+# Все, кроме букв и цифр, при сравнении названий деталей считается одним пробелом
+PART_NAME_SEPARATORS = re.compile(r'[\W_]+')
+
+# Версия таблицы цен: увеличивается при каждой перезагрузке и входит в ключ кэшей поиска,
+# поэтому записи от прошлой таблицы не могут попасть в ответ
+PRICES_VERSION = 0
+# Подпись Excel файла (время изменения и размер), из которого собрана текущая таблица
+PRICES_SIGNATURE = None
+
+# Загрузка таблицы и обновление цен после парсинга выполняются по одному
+PRICES_WRITE_LOCK = Lock()
+# Короткий замок на подмену таблицы вместе с индексами: читатели видят
+# либо старую таблицу целиком, либо новую
+PRICES_SWAP_LOCK = Lock()
+# Сколько результатов поиска марок/моделей/деталей держать в кэше
+LOOKUP_CACHE_SIZE = 512
+# Сколько расчетов ремонта одного повреждения держать в кэше: входы - площадь,
+# материал, тяжесть и тип повреждения, различных сочетаний немного
+DENT_COST_CACHE_SIZE = 4096
 
 # Минимальные и максимальные площади повреждений (см²)
 MIN_DAMAGE_AREA = 50  # минимальная площадь повреждения
 MAX_DAMAGE_AREA = 200 # максимальная площадь повреждения
 
+# ========== ТАБЛИЦЫ СТАВОК И КОЭФФИЦИЕНТОВ ==========
+# Коды материалов, степеней тяжести и типов повреждений - это индексы в таблицах ниже.
+# Неизвестная тяжесть или тип повреждения получают код последнего столбца/строки.
+MATERIALS = ('сталь', 'алюминий', 'магниевый сплав', 'композит', 'пластик')
+SEVERITIES = ('легкий', 'средний', 'тяжелый')
+DAMAGE_TYPES = ('вмятина', 'царапина', 'разрыв')
+
+MATERIAL_CODES = {name: code for code, name in enumerate(MATERIALS)}
+SEVERITY_CODES = {name: code for code, name in enumerate(SEVERITIES)}
+DAMAGE_TYPE_CODES = {name: code for code, name in enumerate(DAMAGE_TYPES)}
+UNKNOWN_SEVERITY_CODE = len(SEVERITIES)
+UNKNOWN_DAMAGE_TYPE_CODE = len(DAMAGE_TYPES)
+
+STEEL_CODE = MATERIAL_CODES['сталь']
+PLASTIC_CODE = MATERIAL_CODES['пластик']
+DENT_CODE = DAMAGE_TYPE_CODES['вмятина']
+SCRATCH_CODE = DAMAGE_TYPE_CODES['царапина']
+
+# Базовые ставки за ремонт вмятин (руб/см²) [материал, тяжесть].
+# Для металлов при неизвестной тяжести ставки нет (0)
+BASE_RATE_TABLE = np.array([
+    # легкий средний тяжелый неизвестно
+    [150,  250,  400,  0],    # сталь
+    [200,  350,  550,  0],    # алюминий: +33% / +40% / +37% к стали
+    [300,  500,  800,  0],    # магниевый сплав: +100% к стали (чаще требуется замена)
+    [400,  700,  1200, 0],    # композит: сложный материал, требует спецоборудования, тяжелые - обычно только замена
+    [100,  100,  200,  100],  # пластик: вмятины - нагрев и выправление, сложные случаи дороже
+], dtype=float)
+
+# Для пластика вне вмятин (царапины) - фиксированная ставка
+PLASTIC_OTHER_RATE = 150
+
+# Коэффициенты стоимости ремонта в зависимости от типа повреждения [тип, тяжесть]
+DAMAGE_MULTIPLIER_TABLE = np.array([
+    # легкий средний тяжелый неизвестно
+    [0.3,  0.5,  0.8,  1.0],  # вмятина: небольшая / средняя / сильная, почти не ремонтируется
+    [0.2,  0.4,  0.7,  1.0],  # царапина: поверхностная / глубокая / очень глубокая до металла
+    [0.6,  0.9,  1.2,  1.0],  # разрыв: тяжелый обычно требует замены
+    [1.0,  1.0,  1.0,  1.0],  # неизвестный тип повреждения
+])
+
+# Множители сложности для разных материалов [материал]
+MATERIAL_MULTIPLIER_TABLE = np.array([
+    1.0,  # сталь
+    1.4,  # алюминий: +40% к стоимости
+    2.0,  # магниевый сплав: +100% к стоимости
+    2.5,  # композит: +150% к стоимости
+    0.8,  # пластик: -20% к стоимости (легче ремонтировать)
+])
+
+# Ставки для царапин на деталях, которых нет в базе (руб/см²) [тяжесть]
+SCRATCH_RATE_TABLE = np.array([
+    80,   # легкий: поверхностная царапина - полировка
+    150,  # средний: шпатлевка и покраска
+    300,  # тяжелый: глубокая царапина - полная покраска
+    150,  # неизвестно
+], dtype=float)
+
+# Множители материалов для царапин на деталях, которых нет в базе [материал]
+SCRATCH_MATERIAL_MULTIPLIER_TABLE = np.array([
+    1.2,  # сталь
+    1.5,  # алюминий
+    1.0,  # магниевый сплав
+    2.0,  # композит
+    1.0,  # пластик
+])
+
+# Таблицы только читаются: запрещаем запись, чтобы случайное изменение
+# не поменяло расчет для всех следующих запросов
+for rate_table in (BASE_RATE_TABLE, DAMAGE_MULTIPLIER_TABLE, MATERIAL_MULTIPLIER_TABLE,
+                   SCRATCH_RATE_TABLE, SCRATCH_MATERIAL_MULTIPLIER_TABLE):
+    rate_table.flags.writeable = False
+
+# Ключевые слова для определения кода по тексту, в порядке приоритета:
+# срабатывает первое совпавшее правило
+MATERIAL_KEYWORDS = (
+    (re.compile('алюмин'), MATERIAL_CODES['алюминий']),
+    (re.compile('магн|сплав'), MATERIAL_CODES['магниевый сплав']),
+    (re.compile('композит|карбон'), MATERIAL_CODES['композит']),
+    (re.compile('пластик|полимер'), PLASTIC_CODE),
+)
+
+# Материал по умолчанию для деталей, которых нет в базе [по названию детали]
+PART_MATERIAL_KEYWORDS = (
+    (re.compile('бампер|обвес|решетка'), PLASTIC_CODE),
+    (re.compile('капот|дверь|крыло|крыша'), STEEL_CODE),
+    (re.compile('фара|стекло|оптика'), MATERIAL_CODES['композит']),
+)
+
+# Типичные цены замены для деталей, которых нет в базе [по названию детали]
+PART_REPLACEMENT_PRICES = (
+    (re.compile('бампер'), 15000),
+    (re.compile('дверь'), 25000),
+    (re.compile('крыло'), 12000),
+    (re.compile('фара'), 8000),
+)
+
 # Демо-фотографии
 DEMO_PHOTOS = {
     'demo1': {
         'name': 'Царапина',
         'description': 'Средняя царапина',
-        'base64': None
+        'url': None
     },
     'demo2': {
         'name': 'Вмятины на дверях',
         'description': 'Множественные виятины на правых дверях',
-        'base64': None
+        'url': None
     },
     'demo3': {
         'name': 'Вмятина',
         'description': 'Вмятина на двери',
-        'base64': None
+        'url': None
     },
     'demo4': {
         'name': 'Царапина',
         'description': 'Царапина на двери',
-        'base64': None
+        'url': None
     }
 }
 
-def convert_image_to_base64(image_path):
-    """Конвертирует изображение в base64"""
+# Содержимое демо-фотографий для маршрута /demo/<demo_id>: demo_id -> (байты, MIME тип).
+# Браузер получает фото обычным запросом по URL, без base64 в JSON
+DEMO_PHOTO_FILES = {}
+
+def read_image_file(image_path):
+    """Читает изображение и возвращает (байты, MIME тип)"""
     try:
         with open(image_path, 'rb') as img_file:
-            encoded_string = base64.b64encode(img_file.read()).decode('utf-8')
+            image_data = img_file.read()
+        
+        # Определяем MIME тип по расширению файла
+        if image_path.lower().endswith('.png'):
+            mime_type = 'image/png'
+        elif image_path.lower().endswith('.gif'):
+            mime_type = 'image/gif'
+        else:
+            mime_type = 'image/jpeg'
             
-            # Определяем MIME тип по расширению файла
-            if image_path.lower().endswith('.png'):
-                mime_type = 'image/png'
-            elif image_path.lower().endswith('.gif'):
-                mime_type = 'image/gif'
-            else:
-                mime_type = 'image/jpeg'
-                
-            return f"data:{mime_type};base64,{encoded_string}"
+        return image_data, mime_type
     except Exception as e:
-        print(f"❌ Ошибка конвертации {image_path}: {e}")
+        logger.error(f"❌ Ошибка чтения {image_path}: {e}")
         return None
 
+@lru_cache(maxsize=1)
+def cached_demo_photos_payload():
+    """JSON ответа /get-demo-photos; сбрасывается при загрузке демо-фото"""
+    return dumps_json_bytes({
+        "success": True,
+        "demo_photos": DEMO_PHOTOS
+    })
+
 def load_demo_photos():
     """Загружает демо-фотографии при запуске сервера"""
     # Список файлов для каждого типа демо-фото
@@ -151,165 +437,419 @@ def load_demo_photos():
         for filename in filenames:
             photo_path = os.path.join(DEMO_PHOTOS_FOLDER, filename)
             if os.path.exists(photo_path):
-                base64_data = convert_image_to_base64(photo_path)
-                if base64_data:
-                    DEMO_PHOTOS[demo_id]['base64'] = base64_data
-                    print(f"✅ Загружено демо-фото: {filename}")
+                photo = read_image_file(photo_path)
+                if photo:
+                    DEMO_PHOTO_FILES[demo_id] = photo
+                    DEMO_PHOTOS[demo_id]['url'] = f"/demo/{demo_id}"
+                    logger.info(f"✅ Загружено демо-фото: {filename}")
                     photo_found = True
                     break
                 else:
-                    print(f"❌ Не удалось загрузить: {filename}")
+                    logger.error(f"❌ Не удалось загрузить: {filename}")
         
         if not photo_found:
             # Создаем заглушку если фото не найдено
-            print(f"⚠️ Файлы для {demo_id} не найдены, создаем заглушку")
-            DEMO_PHOTOS[demo_id]['base64'] = create_placeholder_svg(DEMO_PHOTOS[demo_id]['name'])
+            logger.warning(f"⚠️ Файлы для {demo_id} не найдены, создаем заглушку")
+            DEMO_PHOTO_FILES[demo_id] = (create_placeholder_svg(DEMO_PHOTOS[demo_id]['name']), 'image/svg+xml')
+            DEMO_PHOTOS[demo_id]['url'] = f"/demo/{demo_id}"
+    
+    cached_demo_photos_payload.cache_clear()
 
+@lru_cache(maxsize=32)
 def create_placeholder_svg(name):
-    """Создает SVG заглушку если фото не найдено"""
+    """Создает SVG заглушку если фото не найдено; заглушка для одного названия собирается один раз"""
     svg_content = f'''<svg width="400" height="300" xmlns="http://www.w3.org/2000/svg">
         <rect width="100%" height="100%" fill="#f0f0f0"/>
         <rect x="50" y="50" width="300" height="200" fill="#e0e0e0" stroke="#ccc" stroke-width="2"/>
         <text x="200" y="160" font-family="Arial" font-size="16" text-anchor="middle" fill="#666">{name}</text>
         <text x="200" y="185" font-family="Arial" font-size="12" text-anchor="middle" fill="#999">Загрузите свое фото</text>
     </svg>'''
-    return f"data:image/svg+xml;base64,{base64.b64encode(svg_content.encode()).decode()}"
+    return svg_content.encode()
 
-def load_repair_prices_from_excel(file_path='huh_result.xlsx'):
+def match_keywords(text, keywords, default):
+    """Возвращает значение первого правила из keywords, чей шаблон найден в тексте"""
+    for pattern, value in keywords:
+        if pattern.search(text):
+            return value
+    return default
+
+def classify_materials(materials):
     """
-    Загружает цены на ремонт из Excel файла
-    Ожидаемая структура файла:
-    - Колонки: 'марка', 'модель', 'деталь', 'площадь детали', 'материал детали', 'цена', 'ссылка'
+    Определяет коды базовых материалов по текстовому описанию материала детали.
+    Различных описаний немного, поэтому каждое разбирается один раз
+    """
+    value_codes, unique_materials = pd.factorize(pd.Series(list(materials), dtype=object).astype(str))
+    unique_codes = np.array(
+        [match_keywords(material.lower(), MATERIAL_KEYWORDS, STEEL_CODE) for material in unique_materials],
+        dtype=np.intp
+    )
+    return unique_codes[value_codes] if len(unique_codes) else np.zeros(0, dtype=np.intp)
+
+def build_car_prices_index(df):
+    """
+    Строит индексы для быстрого поиска деталей по марке и модели,
+    чтобы не сканировать всю таблицу на каждый запрос.
+    Возвращает (индекс деталей, модели по маркам, марки, строки деталей по названию)
+    """
+    if df is None:
+        return {}, {}, [], {}
+    
+    group_positions = df.groupby(['марка', 'модель'], sort=False, observed=True).indices
+    
+    # Название детали нормализуется один раз на категорию, а не на строку
+    part_names = df['деталь'].astype('category')
+    part_codes = part_names.cat.codes.to_numpy()
+    part_keys = [normalize_part_name(name) for name in part_names.cat.categories]
+    part_rows_index = {}
+    
+    # Таблица отсортирована по марке и модели, поэтому строки каждой модели идут подряд
+    # и выбираются срезом без копирования позиций
+    parts_index = {}
+    models_by_brand = {}
+    for (brand, model), positions in group_positions.items():
+        if positions[-1] - positions[0] + 1 == len(positions):
+            parts_index[(brand, model)] = slice(positions[0], positions[-1] + 1)
+        else:
+            parts_index[(brand, model)] = positions
+        models_by_brand.setdefault(brand, []).append(model)
+        
+        # Обход с конца: при повторах детали остается первая строка, как в таблице
+        part_rows = {}
+        for position in positions[::-1]:
+            part_rows[part_keys[part_codes[position]]] = int(position)
+        part_rows_index[(brand, model)] = part_rows
+    
+    models_by_brand = {brand: sorted(models) for brand, models in models_by_brand.items()}
+    return parts_index, models_by_brand, sorted(models_by_brand), part_rows_index
+
+def normalize_part_name(name):
+    """Приводит название детали к виду для сравнения: нижний регистр, без знаков препинания"""
+    return PART_NAME_SEPARATORS.sub(' ', str(name).lower()).strip()
+
+def publish_car_prices(df, signature, indexes=None):
+    """
+    Подменяет таблицу цен и ее индексы одним шагом. Новая версия таблицы
+    делает старые записи кэшей поиска недостижимыми, а LRU их вытесняет
     """
-    global CAR_PRICES_DF
+    global CAR_PRICES_DF, CAR_PARTS_INDEX, MODELS_BY_BRAND, BRANDS, PART_ROWS_INDEX
+    global PRICES_SIGNATURE, PRICES_VERSION
+    if indexes is None:
+        indexes = build_car_prices_index(df)
+    
+    with PRICES_SWAP_LOCK:
+        CAR_PARTS_INDEX, MODELS_BY_BRAND, BRANDS, PART_ROWS_INDEX = indexes
+        CAR_PRICES_DF = df
+        PRICES_SIGNATURE = signature
+        # Версию меняем последней: кто увидел новую версию, увидит и новые данные
+        PRICES_VERSION += 1
+
+def get_car_prices_snapshot():
+    """Возвращает согласованные (таблица цен, индекс деталей, строки деталей по названию)"""
+    with PRICES_SWAP_LOCK:
+        return CAR_PRICES_DF, CAR_PARTS_INDEX, PART_ROWS_INDEX
+
+def get_prices_cache_path(file_path):
+    """Возвращает путь к Parquet-кэшу рядом с Excel файлом"""
+    return os.path.splitext(file_path)[0] + '.parquet'
+
+def get_prices_cache_meta_path(file_path):
+    """Возвращает путь к файлу с отметкой версии Excel, из которой собран кэш"""
+    return get_prices_cache_path(file_path) + '.meta'
+
+def get_excel_signature(file_path):
+    """Время изменения и размер Excel файла - по ним определяется актуальность кэша"""
+    stat = os.stat(file_path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+def hash_excel_file(file_path):
+    """Хэш содержимого Excel файла: по нему кэш узнает файл, у которого поменялось только время"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_prices_cache(file_path):
+    """
+    Читает уже разобранную таблицу цен из Parquet-кэша,
+    если кэш собран из текущей версии Excel файла.
+    Сначала сравниваются время изменения и размер, при расхождении - хэш содержимого
+    """
+    cache_path = get_prices_cache_path(file_path)
+    meta_path = get_prices_cache_meta_path(file_path)
     try:
-        if not os.path.exists(file_path):
-            print(f"❌ Файл {file_path} не найден")
-            CAR_PRICES_DF = None
+        if not os.path.exists(cache_path) or not os.path.exists(meta_path):
             return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            cached_meta = json.load(f)
         
-        df = pd.read_excel(file_path)
-        print(f"✅ Файл загружен, колонки: {list(df.columns)}")
-        
-        # Проверяем наличие необходимых колонок
-        required_columns = ['марка', 'модель', 'деталь', 'площадь детали', 'материал детали', 'цена']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        
-        if missing_columns:
-            print(f"❌ Отсутствуют колонки: {missing_columns}")
-            CAR_PRICES_DF = None
-            raise ValueError(f"Отсутствуют колонки: {missing_columns}")
-        
-        # Преобразуем все данные в строки чтобы избежать проблем с сортировкой
-        df['марка'] = df['марка'].astype(str).str.strip()
-        df['модель'] = df['модель'].astype(str).str.strip()
-        df['деталь'] = df['деталь'].astype(str).str.strip()
-        df['площадь детали'] = df['площадь детали'].astype(str).str.strip()
-        df['материал детали'] = df['материал детали'].astype(str).str.strip()
-        
-        # Обрабатываем ссылку если она есть
-        if 'ссылка' in df.columns:
-            df['ссылка'] = df['ссылка'].astype(str).str.strip()
-            # Заменяем NaN и 'nan' на пустые строки
-            df['ссылка'] = df['ссылка'].replace(['nan', 'None', 'NaN'], '')
-        else:
-            df['ссылка'] = ''
+        signature = get_excel_signature(file_path)
+        if {key: cached_meta.get(key) for key in signature} != signature:
+            content_hash = hash_excel_file(file_path)
+            if cached_meta.get('blake2b') != content_hash:
+                logger.info(f"🔄 Кэш {cache_path} собран из другой версии Excel, читаем Excel")
+                return None
+            # Файл тот же, изменилось только время (например, после копирования) - обновляем отметку
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump({**signature, "blake2b": content_hash}, f)
         
-        # Убедимся что цена - число
-        df['цена'] = pd.to_numeric(df['цена'], errors='coerce').fillna(0).astype(int)
+        df = pd.read_parquet(cache_path)
+        if 'material_code' not in df.columns:
+            return None
+        if not is_sorted_by_car(df):
+            logger.info(f"🔄 Кэш {cache_path} не отсортирован по марке и модели, читаем Excel")
+            return None
         
-        CAR_PRICES_DF = df
-        print(f"✅ Успешно загружено {len(df)} записей из {file_path}")
-        print(f"📊 Пример данных:")
-        print(df.head(3))
+        logger.info(f"✅ Данные загружены из кэша {cache_path}")
         return df
-    
     except Exception as e:
-        print(f"❌ Ошибка загрузки Excel файла: {e}")
-        CAR_PRICES_DF = None
+        logger.warning(f"⚠️ Не удалось прочитать кэш {cache_path}: {e}")
         return None
 
-# Загружаем данные при старте сервера
-load_repair_prices_from_excel()
-load_demo_photos()
+def is_sorted_by_car(df):
+    """Проверяет, что строки таблицы упорядочены по марке и модели"""
+    return pd.MultiIndex.from_arrays([df['марка'], df['модель']]).is_monotonic_increasing
+
+def write_prices_cache(df, file_path):
+    """
+    Сохраняет разобранную таблицу цен в Parquet-кэш вместе с отметкой версии Excel.
+    Отметка пишется последней, поэтому недописанный кэш не будет прочитан
+    """
+    cache_path = get_prices_cache_path(file_path)
+    meta_path = get_prices_cache_meta_path(file_path)
+    try:
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        df.to_parquet(cache_path, index=False, compression='zstd')
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump({**get_excel_signature(file_path), "blake2b": hash_excel_file(file_path)}, f)
+        logger.info(f"💾 Кэш таблицы цен сохранен: {cache_path}")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось сохранить кэш {cache_path}: {e}")
+
+def normalize_repair_prices(df):
+    """
+    Проверяет структуру таблицы цен и приводит колонки к нужным типам
+    """
+    # Проверяем наличие необходимых колонок
+    required_columns = ['марка', 'модель', 'деталь', 'площадь детали', 'материал детали', 'цена']
+    missing_columns = [col for col in required_columns if col not in df.columns]
+    
+    if missing_columns:
+        logger.error(f"❌ Отсутствуют колонки: {missing_columns}")
+        raise ValueError(f"Отсутствуют колонки: {missing_columns}")
+    
+    if 'ссылка' not in df.columns:
+        df['ссылка'] = ''
+    
+    # Преобразуем все данные в строки чтобы избежать проблем с сортировкой.
+    # Колонки, которые pandas уже прочитал как строки, не копируем повторно
+    for col in STRING_COLUMNS:
+        column = df[col]
+        if not isinstance(column.dtype, pd.StringDtype):
+            column = column.astype(str)
+        df[col] = column.str.strip()
+    
+    # Заменяем NaN и 'nan' в ссылках на пустые строки
+    df['ссылка'] = df['ссылка'].fillna('').replace(['nan', 'None', 'NaN'], '')
+    
+    # Убедимся что цена - число. Числовую колонку (обычный случай для Excel)
+    # не разбираем повторно, а целую не заполняем
+    prices = df['цена']
+    if not pd.api.types.is_numeric_dtype(prices):
+        prices = pd.to_numeric(prices, errors='coerce')
+    if not pd.api.types.is_integer_dtype(prices):
+        prices = prices.fillna(0)
+    price_dtype = np.int32 if prices.max() <= np.iinfo(np.int32).max else np.int64
+    df['цена'] = prices.astype(price_dtype)
+    
+    # Базовый материал определяем один раз при загрузке, а не для каждого повреждения
+    df['material_code'] = classify_materials(df['материал детали']).astype(np.int8)
+    
+    # Повторяющиеся строки храним как категории: сравнения идут по целым кодам
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype('category')
+    
+    # Группируем строки по марке и модели, чтобы поиск деталей модели был срезом.
+    # Сортировка устойчивая: порядок деталей внутри модели остается как в Excel
+    df = df.sort_values(['марка', 'модель'], kind='stable', ignore_index=True)
+    
+    return df
+
+def load_repair_prices_from_excel(file_path='huh_result.xlsx'):
+    """
+    Загружает цены на ремонт из Excel файла
+    Разобранная таблица кэшируется в Parquet, пока Excel файл не изменится.
+    Если таблица уже собрана из этой же версии файла, повторно не загружается
+    Ожидаемая структура файла:
+    - Колонки: 'марка', 'модель', 'деталь', 'площадь детали', 'материал детали', 'цена', 'ссылка'
+    """
+    with PRICES_WRITE_LOCK:
+        try:
+            if not os.path.exists(file_path):
+                logger.error(f"❌ Файл {file_path} не найден")
+                publish_car_prices(None, None)
+                return None
+            
+            signature = get_excel_signature(file_path)
+            if CAR_PRICES_DF is not None and signature == PRICES_SIGNATURE:
+                logger.info(f"✅ Таблица цен уже загружена из текущей версии {file_path}")
+                return CAR_PRICES_DF
+            
+            df = read_prices_cache(file_path)
+            if df is None:
+                df = pd.read_excel(file_path, engine=EXCEL_ENGINE)
+                logger.info(f"✅ Файл загружен, колонки: {list(df.columns)}")
+                
+                df = normalize_repair_prices(df)
+                write_prices_cache(df, file_path)
+            
+            publish_car_prices(df, signature)
+            logger.info(f"✅ Успешно загружено {len(df)} записей из {file_path}")
+            logger.info(f"📊 Пример данных:\n{df.head(3)}")
+            return df
+        
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки Excel файла: {e}")
+            publish_car_prices(None, None)
+            return None
 
 def get_unique_brands():
     """Получает уникальные марки автомобилей"""
-    global CAR_PRICES_DF
+    wait_for_prices_loaded()
+    return cached_unique_brands(PRICES_VERSION)
+
+def get_models_by_brand(brand):
+    """Получает модели по марке"""
+    wait_for_prices_loaded()
+    return cached_models_by_brand(PRICES_VERSION, brand)
+
+def get_all_parts_for_model(brand, model):
+    """
+    Получает все уникальные детали для конкретной марки и модели из базы данных
+    """
+    wait_for_prices_loaded()
+    return cached_parts_for_model(PRICES_VERSION, brand, model)
+
+@lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def cached_unique_brands(version):
+    """Марки для версии таблицы version"""
     if CAR_PRICES_DF is None:
         return []
     try:
-        brands = CAR_PRICES_DF['марка'].unique().tolist()
-        print(f"🔧 Найдены марки: {brands}")
-        return sorted(brands)
+        brands = BRANDS
+        logger.info(f"🔧 Найдены марки: {brands}")
+        return brands
     except Exception as e:
-        print(f"❌ Ошибка получения марок: {e}")
+        logger.error(f"❌ Ошибка получения марок: {e}")
         return []
 
-def get_models_by_brand(brand):
-    """Получает модели по марке"""
-    global CAR_PRICES_DF
+@lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def cached_models_by_brand(version, brand):
+    """Модели марки для версии таблицы version"""
     if CAR_PRICES_DF is None:
         return []
     try:
-        models = CAR_PRICES_DF[CAR_PRICES_DF['марка'] == brand]['модель'].unique().tolist()
-        print(f"🔧 Для марки '{brand}' найдены модели: {models}")
-        return sorted(models)
+        models = MODELS_BY_BRAND.get(brand, [])
+        logger.info(f"🔧 Для марки '{brand}' найдены модели: {models}")
+        return models
     except Exception as e:
-        print(f"❌ Ошибка при получении моделей для марки {brand}: {e}")
+        logger.error(f"❌ Ошибка при получении моделей для марки {brand}: {e}")
         return []
 
-def get_all_parts_for_model(brand, model):
-    """
-    Получает все уникальные детали для конкретной марки и модели из базы данных
-    """
-    global CAR_PRICES_DF
+@lru_cache(maxsize=LOOKUP_CACHE_SIZE)
+def cached_parts_for_model(version, brand, model):
+    """Уникальные детали марки и модели для версии таблицы version"""
     try:
-        if CAR_PRICES_DF is None:
+        df, parts_index, _ = get_car_prices_snapshot()
+        if df is None:
             return []
         
-        parts = CAR_PRICES_DF[
-            (CAR_PRICES_DF['марка'] == brand) & 
-            (CAR_PRICES_DF['модель'] == model)
-        ]['деталь'].unique().tolist()
+        rows = parts_index.get((brand, model), slice(0, 0))
+        parts = df['деталь'].iloc[rows].unique().tolist()
         
-        print(f"🔧 Для {brand} {model} найдено {len(parts)} уникальных деталей")
+        logger.info(f"🔧 Для {brand} {model} найдено {len(parts)} уникальных деталей")
         return parts
         
     except Exception as e:
-        print(f"❌ Ошибка получения деталей для модели: {e}")
+        logger.error(f"❌ Ошибка получения деталей для модели: {e}")
         return []
 
 def find_car_parts(brand, model):
     """
     Ищет детали для конкретной марки и модели в таблице
     """
-    global CAR_PRICES_DF
+    wait_for_prices_loaded()
     try:
-        if CAR_PRICES_DF is None:
+        df, parts_index, _ = get_car_prices_snapshot()
+        if df is None:
             return pd.DataFrame()
             
-        # Фильтруем детали для указанной марки и модели
-        matching_parts = CAR_PRICES_DF[
-            (CAR_PRICES_DF['марка'] == brand) & 
-            (CAR_PRICES_DF['модель'] == model)
-        ]
+        # Берем строки марки и модели из заранее построенного индекса
+        rows = parts_index.get((brand, model), slice(0, 0))
+        matching_parts = df.iloc[rows]
         
-        print(f"🔧 Для {brand} {model} найдено {len(matching_parts)} деталей")
+        logger.info(f"🔧 Для {brand} {model} найдено {len(matching_parts)} деталей")
         return matching_parts
     
     except Exception as e:
-        print(f"❌ Ошибка поиска деталей: {e}")
+        logger.error(f"❌ Ошибка поиска деталей: {e}")
         return pd.DataFrame()
 
+def load_repair_prices_in_background():
+    """
+    Загружает таблицу цен в отдельном потоке, чтобы сервер начал принимать
+    запросы сразу, не дожидаясь разбора Excel
+    """
+    def loading_thread():
+        try:
+            if load_repair_prices_from_excel() is None:
+                logger.error("❌ Не удалось загрузить данные из Excel файла")
+                logger.info("📋 Убедитесь, что файл huh_result.xlsx существует со следующими колонками:")
+                logger.info("   - марка, модель, деталь, площадь детали, материал детали, цена, ссылка")
+        finally:
+            PRICES_LOADED.set()
+    
+    thread = Thread(target=loading_thread)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def wait_for_prices_loaded(timeout=PRICES_LOAD_TIMEOUT):
+    """
+    Ожидает завершения первой загрузки таблицы цен (сразу возвращается, если она уже прошла)
+    """
+    return PRICES_LOADED.wait(timeout)
+
+def warm_up_damage_models():
+    """
+    Загружает модели анализа при старте сервера в потоке анализа,
+    чтобы первый запрос не ждал их загрузки
+    """
+    if cv_load_models is None:
+        return None
+    
+    def loading_task():
+        try:
+            cv_load_models()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось заранее загрузить модели анализа: {e}")
+    
+    return CV_EXECUTOR.submit(loading_task)
+
+# Загружаем данные при старте сервера
+load_repair_prices_in_background()
+load_demo_photos()
+warm_up_damage_models()
+
 def analyze_damage_with_ai(photo_path, brand, model):
     """
-    Вызывает сторонний скрипт для анализа повреждений на фото
+    Анализирует повреждения на фото модулем cvmain (или сторонним скриптом, если модуль недоступен)
     Возвращает данные с типами повреждений (вмятина/царапина/разрыв) и размерами
     """
     try:
-        if not os.path.exists(DAMAGE_ANALYSIS_SCRIPT):
-            print(f"❌ Скрипт анализа повреждений не найден: {DAMAGE_ANALYSIS_SCRIPT}")
+        if cv_analyze_batch is None and not os.path.exists(DAMAGE_ANALYSIS_SCRIPT):
+            logger.error(f"❌ Скрипт анализа повреждений не найден: {DAMAGE_ANALYSIS_SCRIPT}")
             # Определяем тип повреждения на основе имени файла или пути
             damage_type = "вмятина"
             if "царапин" in photo_path.lower() or "scratch" in photo_path.lower():
@@ -395,296 +935,456 @@ def analyze_damage_with_ai(photo_path, brand, model):
                     ]
                 }
         
-        print(f"🔍 Запускаем анализ повреждений для {brand} {model}")
+        logger.info(f"🔍 Запускаем анализ повреждений для {brand} {model}")
         
-        temp_dir = tempfile.gettempdir()
-        output_file = os.path.join(temp_dir, f"damage_analysis_{random.randint(1000, 9999)}.json")
+        if cv_analyze_batch is None:
+            return run_damage_analysis_script(photo_path, brand, model)
+        
+        # Фото ставится в очередь, а поток анализа разберет ее пакетом вместе с соседними запросами
+        future = Future()
+        CV_BATCH_QUEUE.put((photo_path, brand, model, future))
+        CV_EXECUTOR.submit(run_analysis_batch)
+        try:
+            analysis_result = future.result(timeout=DAMAGE_ANALYSIS_TIMEOUT)
+        except FutureTimeoutError:
+            # Еще не начатый анализ больше не нужен
+            future.cancel()
+            raise
         
-        # Запускаем сторонний скрипт
-        result = subprocess.run([
-            'python', DAMAGE_ANALYSIS_SCRIPT,
-            '--image', photo_path,
-            '--brand', brand,
-            '--model', model,
-            '--output', output_file
-        ], capture_output=True, text=True, timeout=120)
+        logger.info("✅ Анализ повреждений завершен успешно")
+        logger.info(f"📊 Результат анализа: {analysis_result}")
+        return analysis_result
         
-        if result.returncode == 0:
-            print("✅ Анализ повреждений завершен успешно")
+    except FutureTimeoutError:
+        logger.error("❌ Таймаут при анализе повреждений")
+        return None
+    except Exception as e:
+        logger.error(f"❌ Ошибка при анализе повреждений: {e}")
+        return None
+
+def run_analysis_batch():
+    """
+    Забирает из CV_BATCH_QUEUE фото, пришедшие за CV_BATCH_WINDOW, и анализирует их
+    одним прогоном моделей. Выполняется в потоке CV_EXECUTOR
+    """
+    try:
+        batch = [CV_BATCH_QUEUE.get_nowait()]
+    except queue.Empty:
+        # Фото уже разобраны предыдущим пакетом
+        return
+    
+    deadline = time.monotonic() + CV_BATCH_WINDOW
+    while len(batch) < CV_BATCH_MAX_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(CV_BATCH_QUEUE.get(timeout=remaining))
+        except queue.Empty:
+            break
+    
+    # Запрос, который уже не ждет результата (таймаут), в пакет не берем
+    batch = [item for item in batch if item[3].set_running_or_notify_cancel()]
+    if not batch:
+        return
+    
+    if len(batch) > 1:
+        logger.info(f"📦 Пакетный анализ {len(batch)} фото")
+    
+    try:
+        results = cv_analyze_batch([(photo_path, brand, model) for photo_path, brand, model, _ in batch])
+        for (_, _, _, future), result in zip(batch, results):
+            future.set_result(result)
+    except Exception as e:
+        for _, _, _, future in batch:
+            future.set_exception(e)
+
+def run_damage_analysis_script(photo_path, brand, model):
+    """
+    Запускает скрипт анализа повреждений отдельным процессом и читает результат из JSON
+    """
+    try:
+        # Результат передается через временный файл: в stdout скрипта пишут логи ultralytics.
+        # Файл удаляется автоматически при выходе из блока, даже при ошибке
+        with tempfile.NamedTemporaryFile('w+b', prefix='damage_analysis_', suffix='.json') as tf:
+            # Запускаем сторонний скрипт
+            result = subprocess.run([
+                'python', DAMAGE_ANALYSIS_SCRIPT,
+                '--image', photo_path,
+                '--brand', brand,
+                '--model', model,
+                '--output', tf.name
+            ], capture_output=True, text=True, timeout=DAMAGE_ANALYSIS_TIMEOUT)
             
-            # Читаем результат из JSON файла
-            if os.path.exists(output_file):
-                with open(output_file, 'r', encoding='utf-8') as f:
-                    analysis_result = json.load(f)
-                print(f"📊 Результат анализа: {analysis_result}")
-                
-                # Удаляем временный файл
-                os.remove(output_file)
-                return analysis_result
-            else:
-                print("❌ Файл с результатами анализа не создан")
+            if result.returncode != 0:
+                logger.error(f"❌ Ошибка при анализе повреждений: {result.stderr}")
                 return None
-        else:
-            print(f"❌ Ошибка при анализе повреждений: {result.stderr}")
+            
+            logger.info("✅ Анализ повреждений завершен успешно")
+            
+            # Скрипт перезаписывает тот же файл, читаем результат через открытый дескриптор
+            tf.seek(0)
+            content = tf.read()
+        
+        if not content:
+            logger.error("❌ Файл с результатами анализа не создан")
             return None
+        
+        analysis_result = orjson.loads(content) if orjson else json.loads(content)
+        logger.info(f"📊 Результат анализа: {analysis_result}")
+        return analysis_result
             
     except subprocess.TimeoutExpired:
-        print("❌ Таймаут при анализе повреждений")
+        logger.error("❌ Таймаут при анализе повреждений")
         return None
     except Exception as e:
-        print(f"❌ Ошибка при вызове скрипта анализа: {e}")
+        logger.error(f"❌ Ошибка при вызове скрипта анализа: {e}")
         return None
 
+def encode_severities(severities):
+    """Преобразует степени тяжести в коды таблиц"""
+    return np.array([SEVERITY_CODES.get(severity, UNKNOWN_SEVERITY_CODE) for severity in severities], dtype=np.intp)
+
+def encode_damage_types(damage_types):
+    """Преобразует типы повреждений в коды таблиц"""
+    return np.array([DAMAGE_TYPE_CODES.get(damage_type, UNKNOWN_DAMAGE_TYPE_CODE) for damage_type in damage_types], dtype=np.intp)
+
+@njit(cache=True)
+def repair_cost_core(areas, base_rates, material_multipliers, damage_multipliers):
+    """
+    Числовое ядро расчета: площадь × ставка × множители, с округлением до сотен
+    """
+    base_costs = areas * base_rates * material_multipliers
+    final_costs = np.ceil(base_costs * damage_multipliers / 100) * 100
+    return final_costs.astype(np.int64)
+
+# Компилируем ядро сразу, чтобы не платить за JIT на первом запросе
+repair_cost_core(np.ones(1), np.ones(1), np.ones(1), np.ones(1))
+
+def calculate_dent_repair_costs(damage_areas, material_codes, severity_codes, damage_type_codes):
+    """
+    Векторный расчет стоимости ремонта для набора повреждений
+    Возвращает массив стоимостей (округленных до сотен) и массив кодов материалов,
+    использованных для расчета
+    """
+    areas = np.asarray(damage_areas, dtype=float)
+    material_codes = np.asarray(material_codes, dtype=np.intp)
+    severity_codes = np.asarray(severity_codes, dtype=np.intp)
+    damage_type_codes = np.asarray(damage_type_codes, dtype=np.intp)
+    
+    is_plastic = material_codes == PLASTIC_CODE
+    
+    # Базовая ставка; для пластика вне вмятин - фиксированная ставка
+    base_rates = BASE_RATE_TABLE[material_codes, severity_codes]
+    base_rates = np.where(is_plastic & (damage_type_codes != DENT_CODE), PLASTIC_OTHER_RATE, base_rates)
+    
+    final_costs = repair_cost_core(
+        areas,
+        base_rates.astype(float),
+        MATERIAL_MULTIPLIER_TABLE[material_codes],
+        DAMAGE_MULTIPLIER_TABLE[damage_type_codes, severity_codes]
+    )
+    
+    # Для металлов без известной тяжести расчет невозможен - считаем как сталь с нулевой стоимостью
+    no_rate = ~is_plastic & (severity_codes == UNKNOWN_SEVERITY_CODE)
+    detected_codes = np.where(no_rate, STEEL_CODE, material_codes)
+    
+    return final_costs, detected_codes
+
+@lru_cache(maxsize=DENT_COST_CACHE_SIZE)
 def calculate_dent_repair_cost(damage_area, material, severity, damage_type):
     """
-    Рассчитывает стоимость ремонта вмятины на основе площади, материала и сложности
+    Рассчитывает стоимость ремонта вмятины на основе площади, материала и сложности.
+    Таблицы ставок не меняются, поэтому результат кэшируется по входным данным
     """
     try:
-        # Нормализуем материал
-        material_lower = material.lower()
-        
-        # Определяем базовый материал для расчета
-        if 'алюмин' in material_lower:
-            base_material = 'алюминий'
-        elif 'магн' in material_lower or 'сплав' in material_lower:
-            base_material = 'магниевый сплав'
-        elif 'композит' in material_lower or 'карбон' in material_lower:
-            base_material = 'композит'
-        elif 'пластик' in material_lower or 'полимер' in material_lower:
-            base_material = 'пластик'
-        else:
-            base_material = 'сталь'  # по умолчанию
-        
-        # Для пластика используем специальную логику
-        if base_material == 'пластик':
-            if damage_type == 'вмятина':
-                # Для пластиковых вмятин - нагрев и выправление
-                base_rate = 100  # руб/см²
-                if severity == 'тяжелый':
-                    base_rate = 200  # сложные случаи
-            else:
-                base_rate = 150  # для царапин на пластике
-        else:
-            # Для металлов используем базовые ставки
-            base_rate = BASE_DENT_REPAIR_RATES[base_material][severity]
-        
-        # Применяем множитель сложности материала
-        material_multiplier = MATERIAL_COMPLEXITY_MULTIPLIERS.get(base_material, 1.0)
-        
-        # Рассчитываем базовую стоимость
-        base_cost = damage_area * base_rate * material_multiplier
-        
-        # Корректируем в зависимости от типа повреждения
-        damage_multiplier = REPAIR_COST_MULTIPLIERS.get(damage_type, {}).get(severity, 1.0)
-        
-        final_cost = base_cost * damage_multiplier
-        
-        # Округляем до сотен
-        final_cost = math.ceil(final_cost / 100) * 100
-        
-        return int(final_cost), base_material
+        costs, detected_codes = calculate_dent_repair_costs(
+            [damage_area],
+            classify_materials([material]),
+            encode_severities([severity]),
+            encode_damage_types([damage_type])
+        )
+        return int(costs[0]), MATERIALS[detected_codes[0]]
         
     except Exception as e:
-        print(f"❌ Ошибка расчета стоимости ремонта: {e}")
+        logger.error(f"❌ Ошибка расчета стоимости ремонта: {e}")
         return 0, 'сталь'
 
+def round_up_to_hundreds(values):
+    """Округляет стоимости вверх до сотен"""
+    return (np.ceil(np.asarray(values, dtype=float) / 100) * 100).astype(np.int64)
+
 def calculate_repair_cost(damage_analysis, brand, model):
     """
     Рассчитывает стоимость ремонта и замены на основе анализа повреждений
     """
-    global CAR_PRICES_DF
+    damages_with_costs, _ = calculate_repair_cost_with_totals(damage_analysis, brand, model)
+    return damages_with_costs
+
+def calculate_repair_cost_with_totals(damage_analysis, brand, model):
+    """
+    Рассчитывает стоимость ремонта и замены на основе анализа повреждений
+    Все повреждения запроса считаются одним векторным проходом
+    Возвращает список повреждений и итоговые стоимости (ремонт, замена)
+    """
     try:
         if not damage_analysis or 'damages' not in damage_analysis:
-            return []
+            return [], (0, 0)
         
-        car_parts = find_car_parts(brand, model)
-        damages_with_costs = []
+        damages = damage_analysis['damages']
+        if not damages:
+            return [], (0, 0)
+        
+        wait_for_prices_loaded()
+        df, _, part_rows_index = get_car_prices_snapshot()
+        model_part_rows = part_rows_index.get((brand, model), {}) if df is not None else {}
         
-        for damage in damage_analysis['damages']:
+        # Собираем входные данные по всем повреждениям
+        damaged_parts = []
+        damage_types = []
+        severities = []
+        damage_areas = []
+        part_rows = []
+        
+        for damage in damages:
             damaged_part = damage.get('part', '')
-            damage_type = damage.get('damage_type', 'вмятина')
-            severity = damage.get('severity', 'средний')
             damage_area = damage.get('area_cm2', random.randint(10,100))  # площадь повреждения в см²
             
+            damaged_parts.append(damaged_part)
+            damage_types.append(damage.get('damage_type', 'вмятина'))
+            severities.append(damage.get('severity', 'средний'))
             # Ограничиваем площадь повреждения разумными пределами
-            damage_area = max(MIN_DAMAGE_AREA, min(damage_area, MAX_DAMAGE_AREA))
+            damage_areas.append(max(MIN_DAMAGE_AREA, min(damage_area, MAX_DAMAGE_AREA)))
             
-            # Ищем деталь в таблице
-            part_data = car_parts[car_parts['деталь'] == damaged_part] if not car_parts.empty else pd.DataFrame()
+            # Ищем деталь в таблице по нормализованному названию
+            part_rows.append(model_part_rows.get(normalize_part_name(damaged_part)))
+        
+        # Из таблицы берем только найденные строки
+        matched_positions = sorted({position for position in part_rows if position is not None})
+        if matched_positions:
+            matched_rows = dict(zip(matched_positions, df.iloc[matched_positions].to_dict(orient='records')))
+            part_rows = [matched_rows[position] if position is not None else None for position in part_rows]
+        
+        found = np.array([row is not None for row in part_rows])
+        parts_lower = [str(damaged_part).lower() for damaged_part in damaged_parts]
+        
+        # Для деталей не из базы определяем материал по умолчанию по типу детали
+        default_material_codes = np.array(
+            [match_keywords(part, PART_MATERIAL_KEYWORDS, STEEL_CODE) for part in parts_lower],
+            dtype=np.intp
+        )
+        
+        part_materials = [str(row['материал детали']) if row is not None else '' for row in part_rows]
+        part_material_codes = [row['material_code'] if row is not None else STEEL_CODE for row in part_rows]
+        material_codes = np.where(found, part_material_codes, default_material_codes)
+        severity_codes = encode_severities(severities)
+        damage_type_codes = encode_damage_types(damage_types)
+        areas = np.array(damage_areas, dtype=float)
+        
+        # Стоимость ремонта по материалу и площади повреждения
+        dent_costs, detected_codes = calculate_dent_repair_costs(
+            areas, material_codes, severity_codes, damage_type_codes
+        )
+        
+        # Деталь найдена в базе - стоимость полной замены из таблицы
+        table_replacement = np.array([int(row['цена']) if row is not None else 0 for row in part_rows], dtype=np.int64)
+        
+        # Для тяжелых повреждений на сложных материалах ремонт может быть нецелесообразен
+        hard_material = np.isin(detected_codes, [MATERIAL_CODES['магниевый сплав'], MATERIAL_CODES['композит']])
+        capped = (severity_codes == SEVERITY_CODES['тяжелый']) & hard_material
+        found_repair = np.where(capped, np.minimum(dent_costs, table_replacement), dent_costs)
+        
+        # Деталь не найдена - для царапин своя логика расчета
+        scratch_costs = np.trunc(
+            areas * SCRATCH_RATE_TABLE[severity_codes] * SCRATCH_MATERIAL_MULTIPLIER_TABLE[default_material_codes]
+        ).astype(np.int64)
+        
+        # Ориентировочная стоимость замены царапанной детали по типичным ценам
+        typical_replacement = np.array(
+            [match_keywords(part, PART_REPLACEMENT_PRICES, 0) for part in parts_lower],
+            dtype=np.int64
+        )
+        scratch_replacement = np.where(
+            typical_replacement > 0,
+            typical_replacement,
+            np.maximum(scratch_costs * 3, 10000)  # общая формула для неизвестных деталей
+        )
+        
+        # Для других типов повреждений замена обычно в 2-3 раза дороже ремонта
+        is_scratch = damage_type_codes == SCRATCH_CODE
+        estimated_repair = round_up_to_hundreds(np.where(is_scratch, scratch_costs, dent_costs))
+        estimated_replacement = round_up_to_hundreds(
+            np.where(is_scratch, scratch_replacement, np.trunc(dent_costs * 2.5))
+        )
+        
+        repair_costs = np.where(found, found_repair, estimated_repair)
+        replacement_costs = np.where(found, table_replacement, estimated_replacement)
+        
+        # Рекомендуем ремонт, если он дешевле замены на 30%
+        repair_recommended = repair_costs < replacement_costs * 0.7
+        savings = np.where(repair_recommended, replacement_costs - repair_costs, 0)
+        
+        damages_with_costs = []
+        for i, damage in enumerate(damages):
+            damage_info = {
+                "part": damaged_parts[i],
+                "damage_type": damage_types[i],
+                "severity": severities[i],
+                "confidence": float(damage.get('confidence', 0)),
+                "location": damage.get('location', ''),
+                "damage_area_cm2": damage_areas[i],
+                "damage_depth": damage.get('depth', 'не определена'),
+                "repair_cost": int(repair_costs[i]),
+                "replacement_cost": int(replacement_costs[i]),
+                "recommendation": "ремонт" if repair_recommended[i] else "замена",
+                "savings": int(savings[i])
+            }
             
-            if not part_data.empty:
+            if found[i]:
                 # Деталь найдена в базе - используем точные данные
-                replacement_cost = int(part_data.iloc[0]['цена'])  # Стоимость полной замены
-                part_material = str(part_data.iloc[0]['материал детали'])
-                part_area = str(part_data.iloc[0]['площадь детали'])
-                
-                # Рассчитываем стоимость ремонта на основе материала и площади повреждения
-                repair_cost, detected_material = calculate_dent_repair_cost(
-                    damage_area, part_material, severity, damage_type
-                )
-                
-                # Для тяжелых повреждений на сложных материалах ремонт может быть нецелесообразен
-                if (severity == 'тяжелый' and 
-                    detected_material in ['магниевый сплав', 'композит']):
-                    repair_cost = min(repair_cost, replacement_cost)
+                row = part_rows[i]
                 
                 # Получаем ссылку если она есть
-                link = part_data.iloc[0].get('ссылка', '')
+                link = row.get('ссылка', '')
                 if pd.isna(link) or link in ['', 'nan', 'None']:
                     link = ''
                 
-                # Определяем рекомендацию
-                if repair_cost < replacement_cost * 0.7:  # если ремонт дешевле замены на 30%
-                    recommendation = "ремонт"
-                    savings = replacement_cost - repair_cost
-                else:
-                    recommendation = "замена"
-                    savings = 0
-                
-                damages_with_costs.append({
-                    "part": damaged_part,
-                    "area": part_area,
-                    "material": part_material,
-                    "detected_material": detected_material,
-                    "damage_type": damage_type,
-                    "severity": severity,
-                    "confidence": float(damage.get('confidence', 0)),
-                    "location": damage.get('location', ''),
-                    "damage_area_cm2": damage_area,
-                    "damage_depth": damage.get('depth', 'не определена'),
-                    "repair_cost": repair_cost,
-                    "replacement_cost": replacement_cost,
-                    "recommendation": recommendation,
-                    "savings": savings,
+                damage_info.update({
+                    "area": str(row['площадь детали']),
+                    "material": part_materials[i],
+                    "detected_material": MATERIALS[detected_codes[i]],
                     "link": link,
                     "estimated": False  # Флаг точного расчета
                 })
-                
             else:
                 # Деталь не найдена в базе - используем приблизительный расчет
-                # Особенно для царапин, которые могут быть на любой поверхности
-                
-                # Определяем материал по умолчанию в зависимости от типа детали
-                if any(keyword in damaged_part.lower() for keyword in ['бампер', 'обвес', 'решетка']):
-                    default_material = 'пластик'
-                elif any(keyword in damaged_part.lower() for keyword in ['капот', 'дверь', 'крыло', 'крыша']):
-                    default_material = 'сталь'
-                elif any(keyword in damaged_part.lower() for keyword in ['фара', 'стекло', 'оптика']):
-                    default_material = 'композит'
-                else:
-                    default_material = 'сталь'  # по умолчанию
-                
-                # Для царапин используем специальную логику расчета
-                if damage_type == 'царапина':
-                    # Базовые ставки для царапин (руб/см²)
-                    scratch_rates = {
-                        'легкий': 80,    # Поверхностная царапина - полировка
-                        'средний': 150,  # Средняя царапина - шпатлевка и покраска
-                        'тяжелый': 300   # Глубокая царапина - полная покраска
-                    }
-                    
-                    # Множители для разных материалов
-                    material_multipliers = {
-                        'пластик': 1.0,
-                        'сталь': 1.2,
-                        'алюминий': 1.5,
-                        'композит': 2.0
-                    }
-                    
-                    base_rate = scratch_rates.get(severity, 150)
-                    material_multiplier = material_multipliers.get(default_material, 1.0)
-                    
-                    # Стоимость ремонта царапины
-                    repair_cost = int(damage_area * base_rate * material_multiplier)
-                    
-                    # Ориентировочная стоимость замены (если деталь не найдена)
-                    # Основано на типичных ценах для разных типов деталей
-                    if 'бампер' in damaged_part.lower():
-                        replacement_cost = 15000  # типичная цена бампера
-                    elif 'дверь' in damaged_part.lower():
-                        replacement_cost = 25000  # типичная цена двери
-                    elif 'крыло' in damaged_part.lower():
-                        replacement_cost = 12000  # типичная цена крыла
-                    elif 'фара' in damaged_part.lower():
-                        replacement_cost = 8000   # типичная цена фары
-                    else:
-                        # Общая формула для неизвестных деталей
-                        replacement_cost = max(repair_cost * 3, 10000)
-                    
-                else:
-                    # Для других типов повреждений используем стандартный расчет
-                    repair_cost, detected_material = calculate_dent_repair_cost(
-                        damage_area, default_material, severity, damage_type
-                    )
-                    
-                    # Ориентировочная стоимость замены
-                    replacement_cost = int(repair_cost * 2.5)  # замена обычно в 2-3 раза дороже ремонта
-                
-                # Округляем до сотен
-                repair_cost = math.ceil(repair_cost / 100) * 100
-                replacement_cost = math.ceil(replacement_cost / 100) * 100
-                
-                # Определяем рекомендацию
-                if repair_cost < replacement_cost * 0.7:
-                    recommendation = "ремонт"
-                    savings = replacement_cost - repair_cost
-                else:
-                    recommendation = "замена"
-                    savings = 0
-                
-                damages_with_costs.append({
-                    "part": damaged_part,
+                damage_info.update({
                     "area": "не определена",
                     "material": "не определен",
-                    "detected_material": default_material,
-                    "damage_type": damage_type,
-                    "severity": severity,
-                    "confidence": float(damage.get('confidence', 0)),
-                    "location": damage.get('location', ''),
-                    "damage_area_cm2": damage_area,
-                    "damage_depth": damage.get('depth', 'не определена'),
-                    "repair_cost": repair_cost,
-                    "replacement_cost": replacement_cost,
-                    "recommendation": recommendation,
-                    "savings": savings,
+                    "detected_material": MATERIALS[default_material_codes[i]],
                     "link": "",
                     "estimated": True  # Флаг приблизительного расчета
                 })
-                
-                print(f"⚠️ Деталь '{damaged_part}' не найдена, использован приблизительный расчет")
+                logger.warning(f"⚠️ Деталь '{damaged_parts[i]}' не найдена, использован приблизительный расчет")
+            
+            damages_with_costs.append(damage_info)
+        
+        # Итоги суммируем по массивам стоимостей, а не по словарям ответа
+        totals = (int(repair_costs.sum()), int(replacement_costs.sum()))
         
-        return damages_with_costs
+        return damages_with_costs, totals
         
     except Exception as e:
-        print(f"❌ Ошибка расчета стоимости: {e}")
-        return []
+        logger.error(f"❌ Ошибка расчета стоимости: {e}")
+        return [], (0, 0)
+
+def shrink_photo_for_analysis(filepath):
+    """
+    Уменьшает фото до ANALYSIS_MAX_SIZE и пересохраняет в JPEG.
+    Для JPEG draft() уменьшает изображение уже при декодировании
+    """
+    try:
+        with Image.open(filepath) as img:
+            if img.width <= ANALYSIS_MAX_SIZE[0] and img.height <= ANALYSIS_MAX_SIZE[1]:
+                return filepath
+            
+            img.draft('RGB', ANALYSIS_MAX_SIZE)
+            # Поворот по EXIF применяем сразу, т.к. при пересохранении EXIF теряется
+            photo = ImageOps.exif_transpose(img).convert('RGB')
+        
+        photo.thumbnail(ANALYSIS_MAX_SIZE, Image.Resampling.LANCZOS)
+        photo.save(filepath, 'JPEG', quality=ANALYSIS_JPEG_QUALITY, optimize=True)
+        logger.info(f"📐 Фото уменьшено до {photo.width}x{photo.height}: {filepath}")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось уменьшить фото {filepath}: {e}")
+    return filepath
+
+def create_upload_file():
+    """
+    Создает новый файл для загруженного фото и возвращает (путь, открытый файл).
+    Файл создается с O_EXCL, поэтому два запроса не могут получить один и тот же файл
+    """
+    while True:
+        filepath = os.path.join(UPLOAD_FOLDER, f"car_photo_{secrets.token_hex(8)}.jpg")
+        try:
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            continue
+        return filepath, os.fdopen(fd, 'wb', buffering=PHOTO_WRITE_BUFFER_SIZE)
 
 def save_uploaded_photo(photo_data):
     """Сохраняет загруженное фото и возвращает путь к файлу"""
     try:
         if not photo_data:
             return None
-            
+        
         # Убираем префикс data:image если есть
-        if ',' in photo_data:
-            photo_data = photo_data.split(',')[1]
+        prefix_end = photo_data.find(',') + 1
+        encoded = photo_data[prefix_end:].encode('ascii')
+        
+        # base64 может прийти с переносами строк (например, по 64 символа + CRLF)
+        encoded = memoryview(encoded.translate(None, BASE64_WHITESPACE))
         
-        # Декодируем base64
-        image_data = base64.b64decode(photo_data)
+        filepath, f = create_upload_file()
         
-        # Создаем имя файла
-        filename = f"car_photo_{random.randint(1000, 9999)}.jpg"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        # Декодируем base64 порциями сразу в файл, не держа в памяти все изображение
+        try:
+            with f:
+                for start in range(0, len(encoded), BASE64_CHUNK_SIZE):
+                    f.write(b64decode_to_bytes(encoded[start:start + BASE64_CHUNK_SIZE]))
+        except Exception:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            raise
+        
+        logger.info(f"✅ Фото сохранено: {filepath}")
+        return filepath
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения фото: {e}")
+        return None
+
+def save_uploaded_file(photo_file):
+    """Сохраняет фото, пришедшее файлом в multipart/form-data, и возвращает путь к файлу"""
+    try:
+        filepath, f = create_upload_file()
+        
+        # Файл копируется на диск потоком, без base64 и без чтения целиком в память
+        try:
+            with f:
+                photo_file.save(f, buffer_size=PHOTO_WRITE_BUFFER_SIZE)
+        except Exception:
+            os.remove(filepath)
+            raise
+        
+        logger.info(f"✅ Фото сохранено: {filepath}")
+        return filepath
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения фото: {e}")
+        return None
+
+def save_demo_photo(demo_id):
+    """
+    Сохраняет копию демо-фото для анализа и возвращает путь к файлу.
+    Браузер присылает только идентификатор демо-фото, само фото уже есть в памяти сервера
+    """
+    try:
+        photo = DEMO_PHOTO_FILES.get(demo_id)
+        if photo is None:
+            logger.error(f"❌ Демо-фото не найдено: {demo_id}")
+            return None
         
-        # Сохраняем изображение
-        with open(filepath, 'wb') as f:
-            f.write(image_data)
+        # Анализ уменьшает фото на месте, поэтому работаем с копией
+        filepath, f = create_upload_file()
+        with f:
+            f.write(photo[0])
         
-        print(f"✅ Фото сохранено: {filepath}")
+        logger.info(f"✅ Демо-фото {demo_id} сохранено: {filepath}")
         return filepath
         
     except Exception as e:
-        print(f"❌ Ошибка сохранения фото: {e}")
+        logger.error(f"❌ Ошибка сохранения демо-фото: {e}")
         return None
 
 # ========== ФУНКЦИИ ПАРСИНГА ==========
@@ -693,1206 +1393,461 @@ def parsing_complete_callback(result):
     """
     Callback функция, вызываемая при завершении парсинга
     """
-    global CAR_PRICES_DF
     try:
         if result['success']:
-            print(f"✅ Автопарсинг завершен для {result['brand']} {result['model']}")
-            print(f"📊 Обработано деталей: {result['parsed_parts']}")
-            print(f"💰 Найдено цен: {result['found_prices']}")
+            logger.info(f"✅ Автопарсинг завершен для {result['brand']} {result['model']}")
+            logger.info(f"📊 Обработано деталей: {result['parsed_parts']}")
+            logger.info(f"💰 Найдено цен: {result['found_prices']}")
             
-            # Перезагружаем данные из Excel
-            CAR_PRICES_DF = load_repair_prices_from_excel()
-            print("🔄 Данные Excel перезагружены с актуальными ценами")
+            # Переносим новые цены и детали в загруженную таблицу; Excel перечитываем,
+            # только если так обновить таблицу не удалось
+            if apply_parsed_prices(result['dataframe'], result['brand'], result['model']):
+                logger.info("🔄 Цены обновлены в памяти без перезагрузки Excel")
+            else:
+                load_repair_prices_from_excel()
+                logger.info("🔄 Данные Excel перезагружены с актуальными ценами")
         else:
-            print(f"❌ Ошибка автопарсинга: {result['error']}")
+            logger.error(f"❌ Ошибка автопарсинга: {result['error']}")
             
     except Exception as e:
-        print(f"❌ Ошибка в callback парсинга: {e}")
+        logger.error(f"❌ Ошибка в callback парсинга: {e}")
+
+def apply_parsed_prices(parsed_df, brand, model, file_path='huh_result.xlsx'):
+    """
+    Обновляет цены и ссылки деталей модели в таблице цен по результатам парсинга,
+    не перечитывая Excel. Как и при записи в Excel, обновляется первая строка с такой деталью,
+    а детали, которых в таблице нет, добавляются новыми строками.
+    Изменения вносятся в копию таблицы, которая затем подменяет текущую, поэтому
+    читатели не видят наполовину обновленных строк.
+    Возвращает False, если так обновить нельзя и таблицу нужно перечитать
+    """
+    with PRICES_WRITE_LOCK:
+        df, parts_index, part_rows_index = get_car_prices_snapshot()
+        rows = parts_index.get((brand, model))
+        if df is None or rows is None or parsed_df is None:
+            return False
+        if parsed_df.empty:
+            return True
+        
+        indexes = (parts_index, MODELS_BY_BRAND, BRANDS, part_rows_index)
+        return patch_car_prices(df, indexes, rows, parsed_df, brand, model, file_path)
+
+def patch_car_prices(df, indexes, rows, parsed_df, brand, model, file_path):
+    """Переносит цены из parsed_df в копию df и публикует ее. Вызывается под PRICES_WRITE_LOCK"""
+    try:
+        positions = np.arange(rows.start, rows.stop) if isinstance(rows, slice) else rows
+        model_parts = df['деталь'].iloc[rows].astype(str).to_numpy()
+        first_positions = pd.Series(positions, index=model_parts)
+        first_positions = first_positions[~first_positions.index.duplicated()]
+        
+        parsed_parts = parsed_df['деталь'].astype(str).str.strip()
+        targets = first_positions.reindex(parsed_parts.to_numpy())
+        is_new = targets.isna().to_numpy()
+        
+        price_dtype = df['цена'].dtype
+        prices = pd.to_numeric(parsed_df['цена'], errors='coerce').fillna(0)
+        if not is_new.any() and prices.max() > np.iinfo(price_dtype).max:
+            return False
+        
+        links = parsed_df['ссылка'].fillna('').astype(str).str.strip().replace(['nan', 'None', 'NaN'], '')
+        
+        existing = ~is_new
+        targets = targets[existing].to_numpy(dtype=np.int64)
+        df = df.copy()
+        if not is_new.any():
+            df.iloc[targets, df.columns.get_loc('цена')] = prices[existing].to_numpy().astype(price_dtype)
+        else:
+            # Тип цены может расшириться после добавления строк, пока пишем в int64
+            df['цена'] = df['цена'].astype(np.int64)
+            df.iloc[targets, df.columns.get_loc('цена')] = prices[existing].to_numpy().astype(np.int64)
+        df.iloc[targets, df.columns.get_loc('ссылка')] = links[existing].to_numpy()
+        
+        if is_new.any():
+            # Новые детали парсер дописал в конец Excel. Приводим таблицу к виду,
+            # как после чтения файла, и перестраиваем индексы - без повторного чтения Excel
+            new_rows = parsed_df.loc[is_new].reindex(columns=df.columns.drop('material_code'))
+            df = pd.concat([df.drop(columns='material_code'), new_rows], ignore_index=True)
+            df = normalize_repair_prices(df)
+            indexes = None
+        
+        # Если строки не добавлялись, порядок не изменился и индексы остаются прежними.
+        # Excel к этому моменту уже обновлен парсером, таблица соответствует его новой версии
+        publish_car_prices(df, get_excel_signature(file_path), indexes)
+        write_prices_cache(df, file_path)
+        
+        logger.info(f"💰 Обновлено {len(targets)} цен и добавлено {int(is_new.sum())} деталей для {brand} {model}")
+        return True
+    
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось обновить цены в памяти: {e}")
+        return False
+
+def build_parsing_status_data(status_snapshot):
+    """
+    Готовит снимок статуса парсинга к отправке клиенту.
+    Поток парсинга кладет в статус только стандартные Python типы, поэтому
+    значения не приводятся повторно
+    """
+    return {
+        "in_progress": status_snapshot['in_progress'],
+        "current_task": status_snapshot['current_task'],
+        "last_completed": status_snapshot['last_completed'] or None
+    }
+
+def refresh_parsing_status_json():
+    """
+    Сериализует текущий статус парсинга в PARSING_STATUS_JSON.
+    Вызывается под PARSING_STATUS_LOCK
+    """
+    global PARSING_STATUS_JSON
+    PARSING_STATUS_JSON = dumps_json_bytes(build_parsing_status_data(PARSING_STATUS))
+
+def notify_parsing_status_changed():
+    """
+    Отмечает изменение статуса парсинга и будит SSE-потоки.
+    Вызывается под PARSING_STATUS_LOCK
+    """
+    global PARSING_STATUS_VERSION
+    refresh_parsing_status_json()
+    PARSING_STATUS_VERSION += 1
+    PARSING_STATUS_CHANGED.notify_all()
+
+# Начальный статус сериализуем сразу, дальше он обновляется при каждом изменении
+with PARSING_STATUS_LOCK:
+    refresh_parsing_status_json()
 
 def start_auto_parsing(brand, model, damaged_parts):
     """
-    Запускает автоматический парсинг в отдельном потоке
+    Запускает автоматический парсинг в пуле потоков и возвращает его Future.
+    Если парсинг этой марки и модели уже идет, возвращает его Future, а не запускает второй
     """
-    def parsing_thread():
-        global PARSING_STATUS
+    key = (brand, model)
+    
+    def update_finished_status(last_completed=None):
+        """Отмечает окончание парсинга; статус остается 'в процессе', пока идут другие"""
+        with PARSING_TASKS_LOCK, PARSING_STATUS_LOCK:
+            running = [f"{task_brand} {task_model}" for task_brand, task_model in PARSING_TASKS if (task_brand, task_model) != key]
+            PARSING_STATUS['in_progress'] = bool(running)
+            PARSING_STATUS['current_task'] = running[0] if running else None
+            if last_completed is not None:
+                PARSING_STATUS['last_completed'] = last_completed
+            notify_parsing_status_changed()
+    
+    def parsing_task():
         try:
-            PARSING_STATUS['in_progress'] = True
-            PARSING_STATUS['current_task'] = f"{brand} {model}"
-            
             # Импортируем здесь чтобы избежать циклических импортов
             from parser import auto_parse_damages, update_excel_with_parsed_data
             
             # Запускаем парсинг
             parsed_df = auto_parse_damages(brand, model, damaged_parts)
             
-            # Обновляем Excel файл
-            update_excel_with_parsed_data(parsed_df)
-            
             # Преобразуем pandas типы в стандартные Python типы для JSON
             found_prices = int((parsed_df['цена'] > 0).sum())  # Преобразуем в int
             
-            # Обновляем статус
-            PARSING_STATUS['in_progress'] = False
-            PARSING_STATUS['last_completed'] = {
+            # Обновляем Excel файл и таблицу в памяти вместе, по одному парсингу за раз
+            with PARSED_PRICES_LOCK:
+                update_excel_with_parsed_data(parsed_df)
+                
+                # Вызываем callback
+                parsing_complete_callback({
+                    'success': True,
+                    'brand': brand,
+                    'model': model,
+                    'parsed_parts': len(damaged_parts),
+                    'found_prices': found_prices,
+                    'dataframe': parsed_df
+                })
+            
+            # Статус обновляем после переноса цен, чтобы клиенты по событию SSE уже видели новые цены
+            update_finished_status({
                 'brand': brand,
                 'model': model,
                 'timestamp': time.time(),
                 'parsed_parts': len(damaged_parts),
                 'found_prices': found_prices
-            }
-            PARSING_STATUS['current_task'] = None
-            
-            # Вызываем callback
-            parsing_complete_callback({
-                'success': True,
-                'brand': brand,
-                'model': model,
-                'parsed_parts': len(damaged_parts),
-                'found_prices': found_prices,
-                'dataframe': parsed_df
             })
                 
         except Exception as e:
-            PARSING_STATUS['in_progress'] = False
-            PARSING_STATUS['current_task'] = None
-            print(f"❌ Ошибка в потоке парсинга: {e}")
+            logger.error(f"❌ Ошибка в потоке парсинга: {e}")
             parsing_complete_callback({
                 'success': False,
                 'error': str(e)
             })
+            update_finished_status()
+        finally:
+            # Цены уже перенесены в таблицу: следующий запрос этой модели запустит новый парсинг
+            with PARSING_TASKS_LOCK:
+                PARSING_TASKS.pop(key, None)
     
-    # Запускаем в отдельном потоке
-    thread = Thread(target=parsing_thread)
-    thread.daemon = True
-    thread.start()
+    with PARSING_TASKS_LOCK:
+        future = PARSING_TASKS.get(key)
+        if future is not None:
+            logger.info(f"⏳ Парсинг для {brand} {model} уже идет, ждем его результат")
+            return future
+        
+        # Статус выставляем до запуска, чтобы ожидание не проскочило раньше парсинга
+        with PARSING_STATUS_LOCK:
+            PARSING_STATUS['in_progress'] = True
+            PARSING_STATUS['current_task'] = f"{brand} {model}"
+            notify_parsing_status_changed()
+        
+        future = PARSING_EXECUTOR.submit(parsing_task)
+        PARSING_TASKS[key] = future
     
-    print(f"🚀 Запущен автоматический парсинг для {brand} {model}")
-    return thread
+    logger.info(f"🚀 Запущен автоматический парсинг для {brand} {model}")
+    return future
 
-def wait_for_parsing_completion(timeout=300):
+def wait_for_parsing_completion(parsing, timeout=300):
     """
-    Ожидает завершения парсинга с таймаутом
+    Ожидает завершения парсинга (Future из start_auto_parsing) с таймаутом
     """
-    start_time = time.time()
-    while PARSING_STATUS['in_progress']:
-        if time.time() - start_time > timeout:
-            print("❌ Таймаут ожидания парсинга")
-            return False
-        time.sleep(2)
-        print("⏳ Ожидаем завершения парсинга...")
+    try:
+        parsing.result(timeout)
+    except FutureTimeoutError:
+        logger.error("❌ Таймаут ожидания парсинга")
+        return False
     return True
 
-# ========== МАРШРУТЫ FLASK ==========
+# ========== ЗАДАЧИ АНАЛИЗА ==========
 
-@app.route('/')
-def index():
-    return '''
-    <!DOCTYPE html>
-    <html lang="ru">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Оценка стоимости ремонта автомобиля</title>
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                max-width: 1000px;
-                margin: 50px auto;
-                padding: 20px;
-                background-color: #f5f5f5;
-            }
-            .container {
-                background: white;
-                padding: 30px;
-                border-radius: 10px;
-                box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            }
-            .form-group {
-                margin-bottom: 20px;
-                position: relative;
-            }
-            label {
-                display: block;
-                margin-bottom: 8px;
-                font-weight: bold;
-                color: #333;
-            }
-            input, select {
-                width: 100%;
-                padding: 12px;
-                border: 2px solid #ddd;
-                border-radius: 6px;
-                font-size: 16px;
-                transition: border-color 0.3s;
-                box-sizing: border-box;
-            }
-            input:focus, select:focus {
-                outline: none;
-                border-color: #007bff;
-            }
-            button {
-                background-color: #007bff;
-                color: white;
-                padding: 15px 30px;
-                border: none;
-                border-radius: 6px;
-                cursor: pointer;
-                font-size: 16px;
-                width: 100%;
-                transition: background-color 0.3s;
-            }
-            button:hover {
-                background-color: #0056b3;
-            }
-            button:disabled {
-                background-color: #6c757d;
-                cursor: not-allowed;
-            }
-            .result {
-                margin-top: 25px;
-                padding: 20px;
-                border-radius: 6px;
-                display: none;
-            }
-            .success {
-                background-color: #d4edda;
-                border: 1px solid #c3e6cb;
-                color: #155724;
-            }
-            .error {
-                background-color: #f8d7da;
-                border: 1px solid #f5c6cb;
-                color: #721c24;
-            }
-            .loading {
-                display: none;
-                text-align: center;
-                margin: 20px 0;
-                padding: 15px;
-            }
-            .damage-item {
-                background: #f8f9fa;
-                margin: 20px 0;
-                padding: 25px;
-                border-radius: 10px;
-                border-left: 4px solid #007bff;
-            }
-            .cost-comparison {
-                display: grid;
-                grid-template-columns: 1fr 1fr;
-                gap: 20px;
-                margin: 20px 0;
-                padding: 20px;
-                background: white;
-                border-radius: 10px;
-                border: 2px solid #e9ecef;
-            }
-            .repair-cost {
-                text-align: center;
-                padding: 20px;
-                background: #e8f5e8;
-                border-radius: 8px;
-                border: 2px solid #28a745;
-            }
-            .replacement-cost {
-                text-align: center;
-                padding: 20px;
-                background: #fff3cd;
-                border-radius: 8px;
-                border: 2px solid #ffc107;
-            }
-            .cost-value {
-                font-size: 1.6em;
-                font-weight: bold;
-                margin: 15px 0;
-            }
-            .repair-value {
-                color: #28a745;
-            }
-            .replacement-value {
-                color: #856404;
-            }
-            .recommendation {
-                text-align: center;
-                padding: 15px;
-                margin: 15px 0;
-                border-radius: 8px;
-                font-weight: bold;
-                font-size: 1.1em;
-            }
-            .recommend-repair {
-                background: #d4edda;
-                color: #155724;
-                border: 2px solid #c3e6cb;
-            }
-            .recommend-replacement {
-                background: #f8d7da;
-                color: #721c24;
-                border: 2px solid #f5c6cb;
-            }
-            .total-cost {
-                font-size: 1.6em;
-                font-weight: bold;
-                color: #28a745;
-                text-align: center;
-                margin-top: 30px;
-                padding: 25px;
-                background: #e8f5e8;
-                border-radius: 10px;
-                border: 3px solid #28a745;
-            }
-            .part-details {
-                display: grid;
-                grid-template-columns: 1fr 1fr;
-                gap: 15px;
-                margin-top: 15px;
-                font-size: 0.95em;
-            }
-            .detail-item {
-                color: #666;
-                padding: 8px 0;
-                border-bottom: 1px solid #eee;
-            }
-            .damage-details {
-                background: #e7f3ff;
-                padding: 15px;
-                border-radius: 8px;
-                margin: 15px 0;
-            }
-            .damage-type-badge {
-                display: inline-block;
-                padding: 6px 15px;
-                border-radius: 20px;
-                font-size: 0.9em;
-                font-weight: bold;
-                margin-left: 10px;
-            }
-            .dent-badge {
-                background: #007bff;
-                color: white;
-            }
-            .scratch-badge {
-                background: #28a745;
-                color: white;
-            }
-            .break-badge {
-                background: #dc3545;
-                color: white;
-            }
-            .material-badge {
-                display: inline-block;
-                padding: 4px 12px;
-                border-radius: 15px;
-                font-size: 0.8em;
-                font-weight: bold;
-                margin-left: 8px;
-            }
-            .steel-badge {
-                background: #6c757d;
-                color: white;
-            }
-            .aluminum-badge {
-                background: #17a2b8;
-                color: white;
-            }
-            .magnesium-badge {
-                background: #e83e8c;
-                color: white;
-            }
-            .composite-badge {
-                background: #6f42c1;
-                color: white;
-            }
-            .plastic-badge {
-                background: #fd7e14;
-                color: white;
-            }
-            .autocomplete-list {
-                position: absolute;
-                border: 1px solid #d4d4d4;
-                border-bottom: none;
-                border-top: none;
-                z-index: 99;
-                top: 100%;
-                left: 0;
-                right: 0;
-                background: white;
-                max-height: 200px;
-                overflow-y: auto;
-                box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-                display: none;
-            }
-            .autocomplete-item {
-                padding: 10px;
-                cursor: pointer;
-                border-bottom: 1px solid #d4d4d4;
-                background: white;
-            }
-            .autocomplete-item:hover {
-                background-color: #e9e9e9;
-            }
-            .autocomplete-active {
-                background-color: #007bff !important;
-                color: white;
-            }
-            .debug-info {
-                margin-top: 10px;
-                padding: 10px;
-                background: #f8f9fa;
-                border-radius: 5px;
-                font-size: 12px;
-                color: #666;
-            }
-            .photo-upload {
-                border: 2px dashed #ddd;
-                border-radius: 6px;
-                padding: 20px;
-                text-align: center;
-                cursor: pointer;
-                transition: border-color 0.3s;
-                margin-bottom: 15px;
-            }
-            .photo-upload:hover {
-                border-color: #007bff;
-            }
-            .photo-upload.dragover {
-                border-color: #007bff;
-                background-color: #f0f8ff;
-            }
-            .photo-preview {
-                max-width: 100%;
-                max-height: 200px;
-                margin-top: 10px;
-                display: none;
-                border-radius: 4px;
-            }
-            .remove-photo {
-                background-color: #dc3545;
-                color: white;
-                border: none;
-                padding: 5px 10px;
-                border-radius: 4px;
-                cursor: pointer;
-                margin-top: 5px;
-            }
-            .remove-photo:hover {
-                background-color: #c82333;
-            }
-            .upload-icon {
-                font-size: 48px;
-                color: #6c757d;
-                margin-bottom: 10px;
-            }
-            .ai-analysis-badge {
-                background: #17a2b8;
-                color: white;
-                padding: 4px 12px;
-                border-radius: 12px;
-                font-size: 0.9em;
-                margin-left: 10px;
-            }
-            .part-link {
-                display: inline-block;
-                background: #007bff;
-                color: white;
-                padding: 8px 16px;
-                border-radius: 6px;
-                text-decoration: none;
-                font-size: 0.95em;
-                margin-top: 10px;
-                transition: background-color 0.3s;
-            }
-            .part-link:hover {
-                background: #0056b3;
-            }
-            .no-link {
-                color: #6c757d;
-                font-style: italic;
-                font-size: 0.9em;
-            }
-            .parsing-status {
-                background: #e7f3ff;
-                padding: 12px;
-                border-radius: 5px;
-                margin: 15px 0;
-                border-left: 4px solid #007bff;
-            }
-            .parsing-message {
-                color: #0066cc;
-                font-weight: bold;
-                margin: 0;
-            }
-            .step-indicator {
-                display: flex;
-                justify-content: space-between;
-                margin: 20px 0;
-                position: relative;
-            }
-            .step {
-                flex: 1;
-                text-align: center;
-                padding: 10px;
-                background: #f8f9fa;
-                border-radius: 5px;
-                margin: 0 5px;
-                font-weight: bold;
-            }
-            .step.active {
-                background: #007bff;
-                color: white;
-            }
-            .step.completed {
-                background: #28a745;
-                color: white;
-            }
-            .damage-area-info {
-                background: #fff3cd;
-                padding: 10px;
-                border-radius: 5px;
-                margin: 10px 0;
-                font-size: 0.9em;
-            }
-            .demo-photos {
-                display: grid;
-                grid-template-columns: repeat(2, 1fr);
-                gap: 15px;
-                margin: 20px 0;
-            }
-            .demo-photo-item {
-                border: 2px solid #ddd;
-                border-radius: 8px;
-                padding: 15px;
-                text-align: center;
-                cursor: pointer;
-                transition: all 0.3s;
-                background: white;
-            }
-            .demo-photo-item:hover {
-                border-color: #007bff;
-                transform: translateY(-2px);
-                box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-            }
-            .demo-photo-item.active {
-                border-color: #28a745;
-                background: #f8fff8;
-            }
-            .demo-photo-preview {
-                width: 100%;
-                height: 120px;
-                object-fit: contain;
-                margin-bottom: 10px;
-                border-radius: 4px;
-                background: #f8f9fa;
-            }
-            .demo-photo-name {
-                font-weight: bold;
-                margin-bottom: 5px;
-                color: #333;
-            }
-            .demo-photo-desc {
-                font-size: 12px;
-                color: #666;
-            }
-            .demo-section {
-                margin: 25px 0;
-                padding: 20px;
-                background: #f8f9fa;
-                border-radius: 8px;
-                border-left: 4px solid #17a2b8;
-            }
-            .demo-section h3 {
-                margin-top: 0;
-                color: #17a2b8;
-                display: flex;
-                align-items: center;
-                gap: 10px;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1 style="text-align: center; color: #333; margin-bottom: 30px;">
-                🚗 AI Оценка стоимости ремонта автомобиля
-            </h1>
-            
-            <div class="step-indicator">
-                <div class="step" id="step1">1. Обновление данных</div>
-                <div class="step" id="step2">2. Анализ фото</div>
-                <div class="step" id="step3">3. Результат</div>
-            </div>
-            
-            <div class="parsing-status" id="parsingStatus">
-                <p class="parsing-message" id="parsingMessage">
-                    🔄 Обновляем цены для этой модели...
-                </p>
-            </div>
-            
-            <form id="carForm">
-                <div class="form-group">
-                    <label for="brand">Марка автомобиля:</label>
-                    <input type="text" id="brand" name="brand" required 
-                           placeholder="Начните вводить марку..." autocomplete="off">
-                    <div id="brandAutocomplete" class="autocomplete-list"></div>
-                </div>
-                
-                <div class="form-group">
-                    <label for="model">Модель автомобиля:</label>
-                    <input type="text" id="model" name="model" required 
-                           placeholder="Сначала выберите марку..." autocomplete="off" disabled>
-                    <div id="modelAutocomplete" class="autocomplete-list"></div>
-                </div>
-                
-                <div class="demo-section">
-                    <h3>🎯 Демо-фотографии для тестирования</h3>
-                    <p style="margin-bottom: 15px; color: #666;">Выберите одну из демо-фотографий для быстрого тестирования системы:</p>
-                    
-                    <div class="demo-photos" id="demoPhotos">
-                        <!-- Демо-фотографии будут добавлены через JavaScript -->
-                    </div>
-                </div>
-                
-                <div class="form-group">
-                    <label for="photo">Или загрузите свое фото повреждений:</label>
-                    <div class="photo-upload" id="photoUpload">
-                        <div class="upload-icon">📷</div>
-                        <div>Нажмите для выбора файла или перетащите фото сюда</div>
-                        <div style="font-size: 12px; color: #666; margin-top: 5px;">
-                            Поддерживаемые форматы: JPG, PNG, GIF (макс. 5MB)
-                        </div>
-                        <input type="file" id="photoInput" accept="image/*" style="display: none;">
-                        <img id="photoPreview" class="photo-preview" alt="Предпросмотр фото">
-                    </div>
-                    <div style="font-size: 12px; color: #dc3545; margin-top: 5px;">
-                        * Фото обязательно для AI анализа повреждений
-                    </div>
-                    <button type="button" id="removePhoto" class="remove-photo" style="display: none;">Удалить фото</button>
-                </div>
-                
-                <button type="submit" id="submitBtn">🔍 Проанализировать повреждения и оценить стоимость</button>
-            </form>
-            
-            <div class="debug-info" id="debugInfo">
-                Статус: <span id="status">Загрузка...</span>
-            </div>
-            
-            <div class="loading" id="loading">
-                <p id="loadingMessage">🤖 AI анализирует повреждения на фото...</p>
-                <p><small>Это может занять несколько секунд</small></p>
-            </div>
-            
-            <div class="result" id="result"></div>
-        </div>
-
-        <script>
-            let allBrands = [];
-            let brandModels = {};
-            let currentPhoto = null;
-            let selectedDemoPhoto = null;
-
-            // Демо-фотографии будут загружены с сервера
-            let demoPhotos = {};
+def start_analysis_job(brand, model, photo_path):
+    """
+    Регистрирует задачу анализа и запускает ее в отдельном потоке, возвращает job_id
+    """
+    job_id = secrets.token_hex(8)
+    now = time.time()
+    
+    with ANALYSIS_JOBS_LOCK:
+        # Убираем задачи, результат которых так и не забрали
+        expired = [key for key, job in ANALYSIS_JOBS.items() if now - job['created'] > ANALYSIS_JOB_TTL]
+        for key in expired:
+            del ANALYSIS_JOBS[key]
+        
+        ANALYSIS_JOBS[job_id] = {
+            'brand': brand,
+            'model': model,
+            'photo_path': photo_path,
+            'status': 'pending',
+            'stage': 'parsing',
+            'result': None,
+            'created': now
+        }
+    
+    thread = Thread(target=run_analysis_job, args=(job_id,), name=f"analysis-{job_id}")
+    thread.daemon = True
+    thread.start()
+    
+    logger.info(f"🧾 Запущена задача анализа {job_id} для {brand} {model}")
+    return job_id
 
-            // Загружаем список марок и демо-фото при загрузке страницы
-            document.addEventListener('DOMContentLoaded', function() {
-                console.log('Загружаем список марок и демо-фото...');
-                
-                // Загружаем марки
-                fetch('/get-brands')
-                    .then(response => response.json())
-                    .then(data => {
-                        console.log('Получены данные марок:', data);
-                        if (data.success) {
-                            allBrands = data.brands;
-                            document.getElementById('status').textContent = `Загружено ${allBrands.length} марок`;
-                            console.log('Марки загружены:', allBrands);
-                        } else {
-                            document.getElementById('status').textContent = 'Ошибка загрузки марок: ' + data.error;
-                            console.error('Ошибка загрузки марок:', data.error);
-                        }
-                    })
-                    .catch(error => {
-                        document.getElementById('status').textContent = 'Ошибка сети при загрузке марок';
-                        console.error('Ошибка сети:', error);
-                    });
-
-                // Загружаем демо-фотографии
-                fetch('/get-demo-photos')
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.success) {
-                            demoPhotos = data.demo_photos;
-                            console.log('Демо-фото загружены:', Object.keys(demoPhotos));
-                            initDemoPhotos();
-                        } else {
-                            console.error('Ошибка загрузки демо-фото:', data.error);
-                        }
-                    })
-                    .catch(error => {
-                        console.error('Ошибка загрузки демо-фото:', error);
-                    });
-                
-                // Запускаем проверку статуса парсинга
-                setInterval(checkParsingStatus, 2000);
-            });
-
-            // Инициализация демо-фотографий
-            function initDemoPhotos() {
-                const demoPhotosContainer = document.getElementById('demoPhotos');
-                demoPhotosContainer.innerHTML = '';
-                
-                Object.keys(demoPhotos).forEach(photoKey => {
-                    const photo = demoPhotos[photoKey];
-                    const photoItem = document.createElement('div');
-                    photoItem.className = 'demo-photo-item';
-                    photoItem.innerHTML = `
-                        <img src="${photo.base64}" alt="${photo.name}" class="demo-photo-preview">
-                        <div class="demo-photo-name">${photo.name}</div>
-                        <div class="demo-photo-desc">${photo.description}</div>
-                    `;
-                    
-                    photoItem.addEventListener('click', function() {
-                        // Сбрасываем предыдущий выбор
-                        document.querySelectorAll('.demo-photo-item').forEach(item => {
-                            item.classList.remove('active');
-                        });
-                        
-                        // Устанавливаем новый выбор
-                        this.classList.add('active');
-                        selectedDemoPhoto = photoKey;
-                        
-                        // Устанавливаем фото как текущее
-                        currentPhoto = photo.base64;
-                        
-                        // Показываем превью в основном блоке загрузки
-                        const photoPreview = document.getElementById('photoPreview');
-                        photoPreview.src = photo.base64;
-                        photoPreview.style.display = 'block';
-                        
-                        // Обновляем текст области загрузки
-                        document.getElementById('photoUpload').innerHTML = `
-                            <div>Демо-фото: ${photo.name}</div>
-                            <div style="font-size: 12px; color: #666; margin-top: 5px;">
-                                ${photo.description}
-                            </div>
-                        `;
-                        document.getElementById('photoUpload').appendChild(photoPreview);
-                        
-                        // Показываем кнопку удаления
-                        document.getElementById('removePhoto').style.display = 'block';
-                        
-                        console.log(`Выбрано демо-фото: ${photo.name}`);
-                    });
-                    
-                    demoPhotosContainer.appendChild(photoItem);
-                });
-            }
+def update_analysis_job(job_id, **fields):
+    """Обновляет поля задачи анализа"""
+    with ANALYSIS_JOBS_LOCK:
+        job = ANALYSIS_JOBS.get(job_id)
+        if job is not None:
+            job.update(fields)
 
-            // Функция для проверки статуса парсинга
-            function checkParsingStatus() {
-                fetch('/parsing-status')
-                    .then(response => response.json())
-                    .then(data => {
-                        const statusDiv = document.getElementById('parsingStatus');
-                        if (data.in_progress) {
-                            statusDiv.style.display = 'block';
-                            document.getElementById('parsingMessage').textContent = 
-                                `🔄 Обновляем цены для ${data.current_task}...`;
-                        } else {
-                            statusDiv.style.display = 'none';
-                            if (data.last_completed) {
-                                console.log(`✅ Парсинг завершен для ${data.last_completed.brand} ${data.last_completed.model}`);
-                            }
-                        }
-                    })
-                    .catch(error => {
-                        console.error('Ошибка проверки статуса парсинга:', error);
-                    });
-            }
+def run_analysis_job(job_id):
+    """
+    Выполняет задачу анализа в фоне и сохраняет результат в ANALYSIS_JOBS
+    """
+    with ANALYSIS_JOBS_LOCK:
+        job = dict(ANALYSIS_JOBS[job_id])
+    
+    try:
+        result = run_damage_analysis_pipeline(job_id, job['brand'], job['model'], job['photo_path'])
+    except Exception as e:
+        logger.error(f"❌ Ошибка в задаче анализа {job_id}: {e}")
+        result = {
+            "success": False,
+            "error": f"Внутренняя ошибка сервера: {str(e)}"
+        }
+    
+    update_analysis_job(job_id, status='done', stage='done', result=result)
+    logger.info(f"🏁 Задача анализа {job_id} завершена: {'успех' if result.get('success') else 'ошибка'}")
 
-            // Обновление индикатора шагов
-            function updateStepIndicator(step, status) {
-                const stepElement = document.getElementById(`step${step}`);
-                stepElement.className = 'step';
-                if (status === 'active') {
-                    stepElement.classList.add('active');
-                } else if (status === 'completed') {
-                    stepElement.classList.add('completed');
-                }
+def run_damage_analysis_pipeline(job_id, brand, model, photo_path):
+    """
+    Парсинг актуальных цен, AI анализ фото и расчет стоимости; возвращает данные ответа
+    """
+    # Фото уменьшаем здесь, в потоке задачи: обработчик запроса только пишет файл на диск
+    shrink_photo_for_analysis(photo_path)
+    
+    # 🔄 ПЕРВЫЙ ЭТАП: ЗАПУСКАЕМ АВТОМАТИЧЕСКИЙ ПАРСИНГ И ЖДЕМ ЕГО ЗАВЕРШЕНИЯ
+    logger.info(f"🚀 Запускаем автоматический парсинг для {brand} {model}")
+    all_parts = get_all_parts_for_model(brand, model)
+    
+    if all_parts:
+        # Запускаем парсинг и ждем его завершения; ждет поток задачи, а не обработчик запроса
+        parsing = start_auto_parsing(
+            brand=brand,
+            model=model,
+            damaged_parts=all_parts
+        )
+        logger.info(f"⏳ Ожидаем завершения парсинга для {len(all_parts)} деталей...")
+        
+        # Ждем завершения парсинга
+        if not wait_for_parsing_completion(parsing):
+            return {
+                "success": False,
+                "error": "Таймаут ожидания обновления данных. Попробуйте позже."
             }
+        
+        logger.info("✅ Парсинг завершен, продолжаем анализ...")
+    else:
+        logger.warning(f"⚠️ Для {brand} {model} не найдено деталей для парсинга")
+    
+    # 🔄 ВТОРОЙ ЭТАП: АНАЛИЗ ФОТО С ОБНОВЛЕННЫМИ ДАННЫМИ
+    update_analysis_job(job_id, stage='analyzing')
+    damage_analysis = analyze_damage_with_ai(photo_path, brand, model)
+    
+    if not damage_analysis:
+        return {
+            "success": False,
+            "error": "Не удалось проанализировать повреждения на фото. Проверьте скрипт анализа."
+        }
+    
+    # Рассчитываем стоимость ремонта и замены на основе анализа
+    damages_with_costs, (total_repair_cost, total_replacement_cost) = calculate_repair_cost_with_totals(
+        damage_analysis, brand, model
+    )
+    
+    if not damages_with_costs:
+        return {
+            "success": False,
+            "error": "Не удалось найти детали для анализа повреждений в таблице"
+        }
+    
+    return {
+        "success": True,
+        "brand": brand,
+        "model": model,
+        "damages": damages_with_costs,
+        "total_repair_cost": total_repair_cost,
+        "total_replacement_cost": total_replacement_cost,
+        "analysis_method": "AI",
+        "background_parsing": len(all_parts) if all_parts else 0
+    }
 
-            // Обработка загрузки фото
-            const photoUpload = document.getElementById('photoUpload');
-            const photoInput = document.getElementById('photoInput');
-            const photoPreview = document.getElementById('photoPreview');
-            const removePhotoBtn = document.getElementById('removePhoto');
-
-            // Клик по области загрузки
-            photoUpload.addEventListener('click', function() {
-                photoInput.click();
-            });
-
-            // Выбор файла
-            photoInput.addEventListener('change', function(e) {
-                const file = e.target.files[0];
-                if (file) {
-                    handlePhotoUpload(file);
-                    // Сбрасываем выбор демо-фото при загрузке своего файла
-                    if (selectedDemoPhoto) {
-                        document.querySelectorAll('.demo-photo-item').forEach(item => {
-                            item.classList.remove('active');
-                        });
-                        selectedDemoPhoto = null;
-                    }
-                }
-            });
-
-            // Drag and drop
-            photoUpload.addEventListener('dragover', function(e) {
-                e.preventDefault();
-                photoUpload.classList.add('dragover');
-            });
-
-            photoUpload.addEventListener('dragleave', function() {
-                photoUpload.classList.remove('dragover');
-            });
-
-            photoUpload.addEventListener('drop', function(e) {
-                e.preventDefault();
-                photoUpload.classList.remove('dragover');
-                const file = e.dataTransfer.files[0];
-                if (file && file.type.startsWith('image/')) {
-                    handlePhotoUpload(file);
-                    // Сбрасываем выбор демо-фото при загрузке своего файла
-                    if (selectedDemoPhoto) {
-                        document.querySelectorAll('.demo-photo-item').forEach(item => {
-                            item.classList.remove('active');
-                        });
-                        selectedDemoPhoto = null;
-                    }
-                }
-            });
-
-            // Удаление фото
-            removePhotoBtn.addEventListener('click', function() {
-                currentPhoto = null;
-                selectedDemoPhoto = null;
-                photoInput.value = '';
-                photoPreview.style.display = 'none';
-                removePhotoBtn.style.display = 'none';
-                photoUpload.innerHTML = `
-                    <div class="upload-icon">📷</div>
-                    <div>Нажмите для выбора файла или перетащите фото сюда</div>
-                    <div style="font-size: 12px; color: #666; margin-top: 5px;">
-                        Поддерживаемые форматы: JPG, PNG, GIF (макс. 5MB)
-                    </div>
-                `;
-                
-                // Сбрасываем выбор демо-фото
-                document.querySelectorAll('.demo-photo-item').forEach(item => {
-                    item.classList.remove('active');
-                });
-            });
-
-            function handlePhotoUpload(file) {
-                // Проверка размера файла (5MB)
-                if (file.size > 5 * 1024 * 1024) {
-                    alert('Файл слишком большой. Максимальный размер: 5MB');
-                    return;
-                }
+# ========== МАРШРУТЫ FLASK ==========
 
-                const reader = new FileReader();
-                reader.onload = function(e) {
-                    currentPhoto = e.target.result;
-                    photoPreview.src = currentPhoto;
-                    photoPreview.style.display = 'block';
-                    removePhotoBtn.style.display = 'block';
-                    
-                    // Обновляем текст области загрузки
-                    photoUpload.innerHTML = `
-                        <div>Фото загружено: ${file.name}</div>
-                        <div style="font-size: 12px; color: #666; margin-top: 5px;">
-                            Размер: ${(file.size / 1024 / 1024).toFixed(2)} MB
-                        </div>
-                    `;
-                    photoUpload.appendChild(photoPreview);
-                };
-                reader.readAsDataURL(file);
-            }
+def get_index_page():
+    """
+    Возвращает содержимое страницы (со сжатым CSS), ее ETag и сжатую gzip версию;
+    файл перечитывается и сжимается только после изменения
+    """
+    global INDEX_PAGE_CACHE
+    mtime = os.path.getmtime(INDEX_HTML_PATH)
+    page = INDEX_PAGE_CACHE
+    if page is None or page[0] != mtime:
+        with open(INDEX_HTML_PATH, 'rb') as f:
+            body = minify_inline_styles(f.read())
+        page = (mtime, body, hashlib.md5(body).hexdigest(), gzip.compress(body, 9))
+        INDEX_PAGE_CACHE = page
+    return page[1], page[2], page[3]
 
-            // Автодополнение для марки
-            document.getElementById('brand').addEventListener('input', function(e) {
-                const input = e.target.value;
-                const autocomplete = document.getElementById('brandAutocomplete');
-                
-                if (input.length === 0) {
-                    autocomplete.style.display = 'none';
-                    document.getElementById('model').disabled = true;
-                    document.getElementById('model').value = '';
-                    document.getElementById('model').placeholder = 'Сначала выберите марку...';
-                    document.getElementById('modelAutocomplete').style.display = 'none';
-                    return;
-                }
+def minify_css(css):
+    """Убирает из CSS комментарии и пробелы, не влияющие на стили"""
+    css = CSS_COMMENTS.sub('', css)
+    css = CSS_WHITESPACE.sub(' ', css)
+    css = CSS_PUNCTUATION_SPACES.sub(r'\1', css)
+    return css.replace(';}', '}').strip()
 
-                // Фильтруем марки по введенному тексту
-                const filteredBrands = allBrands.filter(brand => 
-                    brand.toLowerCase().includes(input.toLowerCase())
-                );
+def minify_inline_styles(html):
+    """Сжимает CSS во всех блоках <style> страницы"""
+    return STYLE_BLOCK.sub(
+        lambda m: m.group(1) + minify_css(m.group(2).decode('utf-8')).encode('utf-8') + m.group(3),
+        html
+    )
 
-                if (filteredBrands.length === 0) {
-                    autocomplete.style.display = 'none';
-                    return;
-                }
+def accepts_gzip():
+    """Проверяет, принимает ли клиент ответы, сжатые gzip"""
+    return 'gzip' in request.accept_encodings
 
-                // Показываем подсказки
-                autocomplete.innerHTML = '';
-                filteredBrands.forEach(brand => {
-                    const item = document.createElement('div');
-                    item.className = 'autocomplete-item';
-                    item.textContent = brand;
-                    item.addEventListener('click', function() {
-                        document.getElementById('brand').value = brand;
-                        autocomplete.style.display = 'none';
-                        // Загружаем модели для выбранной марки
-                        loadModelsForBrand(brand);
-                        document.getElementById('model').disabled = false;
-                        document.getElementById('model').placeholder = 'Начните вводить модель...';
-                        document.getElementById('model').focus();
-                    });
-                    autocomplete.appendChild(item);
-                });
-                autocomplete.style.display = 'block';
-            });
-
-            // Автодополнение для модели
-            document.getElementById('model').addEventListener('input', function(e) {
-                const input = e.target.value;
-                const brand = document.getElementById('brand').value;
-                const autocomplete = document.getElementById('modelAutocomplete');
-                
-                if (input.length === 0 || !brand) {
-                    autocomplete.style.display = 'none';
-                    return;
-                }
+@app.after_request
+def compress_response(response):
+    """Сжимает текстовые ответы gzip; потоки, файлы и уже сжатые ответы не трогает"""
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES
+            or not accepts_gzip()):
+        return response
+    
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    
+    response.set_data(gzip.compress(body, COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
 
-                const models = brandModels[brand] || [];
-                const filteredModels = models.filter(model => 
-                    model.toLowerCase().includes(input.toLowerCase())
-                );
+@app.before_request
+def reject_large_requests():
+    """Отклоняет запрос по заголовку Content-Length, не читая тело"""
+    if request.content_length is not None and request.content_length > MAX_REQUEST_SIZE:
+        raise RequestEntityTooLarge()
 
-                if (filteredModels.length === 0) {
-                    autocomplete.style.display = 'none';
-                    return;
-                }
+@app.errorhandler(413)
+def request_too_large(e):
+    """Слишком большой запрос: отвечаем JSON, как и остальные маршруты"""
+    logger.warning(f"⚠️ Отклонен запрос {request.path} размером {request.content_length} байт")
+    return jsonify({
+        "success": False,
+        "error": "Фото слишком большое. Максимальный размер: 5MB"
+    }), 413
 
-                // Показываем подсказки
-                autocomplete.innerHTML = '';
-                filteredModels.forEach(model => {
-                    const item = document.createElement('div');
-                    item.className = 'autocomplete-item';
-                    item.textContent = model;
-                    item.addEventListener('click', function() {
-                        document.getElementById('model').value = model;
-                        autocomplete.style.display = 'none';
-                    });
-                    autocomplete.appendChild(item);
-                });
-                autocomplete.style.display = 'block';
-            });
-
-            // Загрузка моделей для выбранной марки
-            function loadModelsForBrand(brand) {
-                document.getElementById('status').textContent = `Загрузка моделей для ${brand}...`;
-                
-                fetch('/get-models?brand=' + encodeURIComponent(brand))
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.success) {
-                            brandModels[brand] = data.models;
-                            document.getElementById('status').textContent = `Загружено ${data.models.length} моделей для ${brand}`;
-                        } else {
-                            document.getElementById('status').textContent = 'Ошибка загрузки моделей: ' + data.error;
-                            brandModels[brand] = [];
-                        }
-                    })
-                    .catch(error => {
-                        document.getElementById('status').textContent = 'Ошибка сети при загрузке моделей';
-                        brandModels[brand] = [];
-                    });
-            }
+@app.route('/')
+def index():
+    """Отдает страницу приложения из памяти; повторные заходы получают 304 по ETag"""
+    body, etag, gzip_body = get_index_page()
+    if accepts_gzip():
+        # Сжатая версия подготовлена заранее, и у нее свой ETag
+        response = Response(gzip_body, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += '-gzip'
+    else:
+        response = Response(body, mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    # Страницу всегда перепроверяем по ETag, чтобы после обновления не показывать старую
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
-            // Закрытие автодополнения при клике вне поля
-            document.addEventListener('click', function(e) {
-                if (!e.target.matches('#brand') && !e.target.matches('#model')) {
-                    document.getElementById('brandAutocomplete').style.display = 'none';
-                    document.getElementById('modelAutocomplete').style.display = 'none';
-                }
-            });
+def catalog_response(body, mimetype='application/json'):
+    """
+    Ответ справочника: кэшируется браузером на CATALOG_MAX_AGE, после чего
+    перепроверяется по ETag. ETag слабый, т.к. ответ может уйти сжатым gzip
+    """
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(hashlib.blake2b(body, digest_size=8).hexdigest(), weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = CATALOG_MAX_AGE
+    return response.make_conditional(request)
 
-            // Отправка формы
-            document.getElementById('carForm').addEventListener('submit', function(e) {
-                e.preventDefault();
-                
-                const brand = document.getElementById('brand').value;
-                const model = document.getElementById('model').value;
-                const submitBtn = document.getElementById('submitBtn');
-                
-                // Проверяем что фото загружено
-                if (!currentPhoto) {
-                    alert('Пожалуйста, выберите демо-фото или загрузите свое фото повреждений для анализа');
-                    return;
-                }
-                
-                console.log('Отправка формы:', { brand, model, hasPhoto: !!currentPhoto, demoPhoto: selectedDemoPhoto });
-                
-                // Блокируем кнопку и показываем загрузку
-                submitBtn.disabled = true;
-                submitBtn.textContent = '🔄 Обновляем данные...';
-                document.getElementById('loading').style.display = 'block';
-                document.getElementById('loadingMessage').textContent = '🔄 Обновляем данные о ценах...';
-                document.getElementById('result').style.display = 'none';
-                document.getElementById('status').textContent = 'Обновление данных...';
-                
-                // Обновляем индикатор шагов
-                updateStepIndicator(1, 'active');
-                updateStepIndicator(2, '');
-                updateStepIndicator(3, '');
-                
-                // Скрываем автодополнение
-                document.getElementById('brandAutocomplete').style.display = 'none';
-                document.getElementById('modelAutocomplete').style.display = 'none';
-                
-                // Подготавливаем данные для отправки
-                const formData = {
-                    brand: brand,
-                    model: model,
-                    photo: currentPhoto
-                };
-                
-                // Отправляем данные на сервер
-                fetch('/analyze-damage', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                    },
-                    body: JSON.stringify(formData)
-                })
-                .then(response => response.json())
-                .then(data => {
-                    console.log('Получен ответ:', data);
-                    
-                    // Восстанавливаем кнопку
-                    submitBtn.disabled = false;
-                    submitBtn.textContent = '🔍 Проанализировать повреждения и оценить стоимость';
-                    document.getElementById('loading').style.display = 'none';
-                    
-                    const resultDiv = document.getElementById('result');
-                    
-                    if (data.success) {
-                        resultDiv.className = 'result success';
-                        let html = `<h3>📊 Результаты AI оценки для ${data.brand} ${data.model}</h3>`;
-                        
-                        // Показываем превью фото
-                        if (data.photo_preview) {
-                            html += `<div style="text-align: center; margin: 15px 0;">
-                                        <img src="${data.photo_preview}" style="max-width: 300px; max-height: 200px; border-radius: 8px; border: 2px solid #ddd;">
-                                        <div style="font-size: 12px; color: #666; margin-top: 5px;">Анализируемое фото</div>
-                                    </div>`;
-                        }
-                        
-                        html += `<h4>🔧 Обнаруженные повреждения: <span class="ai-analysis-badge">AI анализ</span></h4>`;
-                        
-                        if (data.damages && data.damages.length > 0) {
-                            let totalRepairCost = 0;
-                            let totalReplacementCost = 0;
-                            
-                            data.damages.forEach(damage => {
-                                totalRepairCost += damage.repair_cost;
-                                totalReplacementCost += damage.replacement_cost;
-                                
-                                // Определяем бейдж для типа повреждения
-                                let damageTypeBadge = '';
-                                let damageBadgeClass = '';
-                                switch(damage.damage_type.toLowerCase()) {
-                                    case 'вмятина':
-                                        damageBadgeClass = 'dent-badge';
-                                        break;
-                                    case 'царапина':
-                                        damageBadgeClass = 'scratch-badge';
-                                        break;
-                                    case 'разрыв':
-                                        damageBadgeClass = 'break-badge';
-                                        break;
-                                    default:
-                                        damageBadgeClass = 'dent-badge';
-                                }
-                                damageTypeBadge = `<span class="damage-type-badge ${damageBadgeClass}">${damage.damage_type}</span>`;
-                                
-                                // Определяем бейдж для материала
-                                let materialBadge = '';
-                                let materialBadgeClass = '';
-                                switch(damage.detected_material.toLowerCase()) {
-                                    case 'сталь':
-                                        materialBadgeClass = 'steel-badge';
-                                        break;
-                                    case 'алюминий':
-                                        materialBadgeClass = 'aluminum-badge';
-                                        break;
-                                    case 'магниевый сплав':
-                                        materialBadgeClass = 'magnesium-badge';
-                                        break;
-                                    case 'композит':
-                                        materialBadgeClass = 'composite-badge';
-                                        break;
-                                    case 'пластик':
-                                        materialBadgeClass = 'plastic-badge';
-                                        break;
-                                    default:
-                                        materialBadgeClass = 'steel-badge';
-                                }
-                                materialBadge = `<span class="material-badge ${materialBadgeClass}">${damage.detected_material}</span>`;
-                                
-                                let linkHtml = '';
-                                if (damage.link && damage.link !== '') {
-                                    linkHtml = `<a href="${damage.link}" target="_blank" class="part-link">🔗 Ссылка на деталь</a>`;
-                                } else {
-                                    linkHtml = `<span class="no-link">🔗 Ссылка не указана</span>`;
-                                }
-                                
-                                // Определяем рекомендацию
-                                const recommendationClass = damage.recommendation === 'ремонт' ? 
-                                    'recommend-repair' : 'recommend-replacement';
-                                const recommendationIcon = damage.recommendation === 'ремонт' ? '🔧' : '🔄';
-                                
-                                html += `
-                                    <div class="damage-item">
-                                        <div style="display: flex; justify-content: space-between; align-items: center;">
-                                            <strong style="font-size: 1.2em;">${damage.part}</strong>
-                                            <div>
-                                                ${damageTypeBadge}
-                                                ${materialBadge}
-                                            </div>
-                                        </div>
-                                        
-                                        <div class="damage-details">
-                                            <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 10px;">
-                                                <div><strong>📏 Площадь повреждения:</strong> ${damage.damage_area_cm2} см²</div>
-                                                <div><strong>📐 Площадь детали:</strong> ${damage.area}</div>
-                                                <div><strong>⚡ Сложность ремонта:</strong> ${damage.severity}</div>
-                                            </div>
-                                            <div style="margin-top: 10px;">
-                                                <strong>📍 Расположение:</strong> ${damage.location}
-                                                <span style="margin-left: 20px;"><strong>🎯 Точность:</strong> ${Math.round(damage.confidence * 100)}%</span>
-                                            </div>
-                                        </div>
-                                        
-                                        <div class="cost-comparison">
-                                            <div class="repair-cost">
-                                                <div>🔧 Ремонт</div>
-                                                <div class="cost-value repair-value">${damage.repair_cost.toLocaleString('ru-RU')} руб.</div>
-                                                <small>Восстановление детали (${damage.damage_area_cm2} см² × материал)</small>
-                                            </div>
-                                            <div class="replacement-cost">
-                                                <div>🔄 Полная замена</div>
-                                                <div class="cost-value replacement-value">${damage.replacement_cost.toLocaleString('ru-RU')} руб.</div>
-                                                <small>Новая деталь</small>
-                                            </div>
-                                        </div>
-                                        
-                                        <div class="recommendation ${recommendationClass}">
-                                            ${recommendationIcon} Рекомендация: <strong>${damage.recommendation.toUpperCase()}</strong>
-                                            ${damage.recommendation === 'ремонт' ? 
-                                                `(экономия ${damage.savings.toLocaleString('ru-RU')} руб.)` : 
-                                                '(ремонт нецелесообразен)'}
-                                        </div>
-                                        
-                                        <div style="margin-top: 15px;">
-                                            ${linkHtml}
-                                        </div>
-                                    </div>
-                                `;
-                            });
-                            
-                            // Общая стоимость
-                            const totalSavings = totalReplacementCost - totalRepairCost;
-                            const finalRecommendation = totalRepairCost < totalReplacementCost ? 'ремонт' : 'замена';
-                            
-                            html += `
-                                <div class="total-cost">
-                                    <div>💵 Общая стоимость ремонта: ${totalRepairCost.toLocaleString('ru-RU')} руб.</div>
-                                    <div>💰 Общая стоимость замены: ${totalReplacementCost.toLocaleString('ru-RU')} руб.</div>
-                                    <div style="margin-top: 15px; font-size: 1.3em; padding: 15px; background: white; border-radius: 8px;">
-                                        🎯 Итоговая рекомендация: <strong>${finalRecommendation.toUpperCase()}</strong>
-                                        ${finalRecommendation === 'ремонт' ? 
-                                            `(экономия ${totalSavings.toLocaleString('ru-RU')} руб.)` : 
-                                            ''}
-                                    </div>
-                                </div>
-                            `;
-                            
-                            // Показываем информацию о фоновом парсинге
-                            if (data.background_parsing > 0) {
-                                html += `<div style="margin-top: 15px; padding: 10px; background: #e7f3ff; border-radius: 5px;">
-                                            <small>🔄 Запущено фоновое обновление цен для ${data.background_parsing} деталей</small>
-                                        </div>`;
-                            }
-                        } else {
-                            html += `<p>❌ AI не обнаружил повреждений на фото</p>`;
-                        }
-                        
-                        resultDiv.innerHTML = html;
-                        
-                        // Обновляем индикатор шагов
-                        updateStepIndicator(1, 'completed');
-                        updateStepIndicator(2, 'completed');
-                        updateStepIndicator(3, 'completed');
-                    } else {
-                        resultDiv.className = 'result error';
-                        resultDiv.innerHTML = `<p>❌ Ошибка: ${data.error}</p>`;
-                        
-                        // Сбрасываем индикатор шагов при ошибке
-                        updateStepIndicator(1, '');
-                        updateStepIndicator(2, '');
-                        updateStepIndicator(3, '');
-                    }
-                    
-                    resultDiv.style.display = 'block';
-                })
-                .catch(error => {
-                    // Восстанавливаем кнопку при ошибке
-                    submitBtn.disabled = false;
-                    submitBtn.textContent = '🔍 Проанализировать повреждения и оценить стоимость';
-                    document.getElementById('loading').style.display = 'none';
-                    
-                    const resultDiv = document.getElementById('result');
-                    resultDiv.className = 'result error';
-                    resultDiv.innerHTML = '<p>❌ Произошла ошибка при отправке запроса</p>';
-                    resultDiv.style.display = 'block';
-                    
-                    // Сбрасываем индикатор шагов при ошибке
-                    updateStepIndicator(1, '');
-                    updateStepIndicator(2, '');
-                    updateStepIndicator(3, '');
-                    
-                    console.error('Error:', error);
-                });
-            });
-        </script>
-    </body>
-    </html>
-    '''
+@lru_cache(maxsize=4)
+def cached_brands_payload(version):
+    """JSON ответа /get-brands для версии таблицы version"""
+    return dumps_json_bytes({
+        "success": True,
+        "brands": cached_unique_brands(version)
+    })
 
 @app.route('/get-brands')
 def get_brands():
     """Возвращает список уникальных марок"""
     try:
-        brands = get_unique_brands()
-        print(f"📡 GET /get-brands -> {len(brands)} марок")
-        return jsonify({
-            "success": True,
-            "brands": brands
-        })
+        wait_for_prices_loaded()
+        body = cached_brands_payload(PRICES_VERSION)
+        logger.info(f"📡 GET /get-brands -> {len(BRANDS)} марок")
+        if not BRANDS:
+            # Пустой список (таблица не загрузилась) браузеру не кэшируем
+            return Response(body, mimetype='application/json')
+        return catalog_response(body)
     except Exception as e:
-        print(f"❌ Ошибка в get_brands: {e}")
+        logger.error(f"❌ Ошибка в get_brands: {e}")
         return jsonify({
             "success": False,
             "error": str(e)
@@ -1903,7 +1858,7 @@ def get_models():
     """Возвращает список моделей для указанной марки"""
     try:
         brand = request.args.get('brand', '')
-        print(f"📡 GET /get-models?brand={brand}")
+        logger.info(f"📡 GET /get-models?brand={brand}")
         
         if not brand:
             return jsonify({
@@ -1917,7 +1872,7 @@ def get_models():
             "models": models
         })
     except Exception as e:
-        print(f"❌ Ошибка в get_models для марки '{brand}': {e}")
+        logger.error(f"❌ Ошибка в get_models для марки '{brand}': {e}")
         return jsonify({
             "success": False,
             "error": str(e)
@@ -1927,169 +1882,189 @@ def get_models():
 def get_demo_photos():
     """Возвращает демо-фотографии"""
     try:
-        print(f"📡 GET /get-demo-photos -> {len(DEMO_PHOTOS)} фото")
-        return jsonify({
-            "success": True,
-            "demo_photos": DEMO_PHOTOS
-        })
+        logger.info(f"📡 GET /get-demo-photos -> {len(DEMO_PHOTOS)} фото")
+        return catalog_response(cached_demo_photos_payload())
     except Exception as e:
-        print(f"❌ Ошибка в get_demo_photos: {e}")
+        logger.error(f"❌ Ошибка в get_demo_photos: {e}")
         return jsonify({
             "success": False,
             "error": str(e)
         })
 
+@app.route('/demo/<demo_id>')
+def demo_photo(demo_id):
+    """Отдает демо-фотографию из памяти как обычное изображение"""
+    photo = DEMO_PHOTO_FILES.get(demo_id)
+    if photo is None:
+        return jsonify({
+            "success": False,
+            "error": "Демо-фото не найдено"
+        }), 404
+    image_data, mime_type = photo
+    return catalog_response(image_data, mime_type)
+
 @app.route('/parsing-status')
 def parsing_status():
     """Возвращает статус фонового парсинга"""
-    # Преобразуем все данные в JSON-сериализуемые типы
-    status_data = {
-        "in_progress": PARSING_STATUS['in_progress'],
-        "current_task": PARSING_STATUS['current_task']
-    }
+    # JSON уже собран при последнем изменении статуса
+    return Response(PARSING_STATUS_JSON, mimetype='application/json')
+
+@app.route('/parsing-status/stream')
+def parsing_status_stream():
+    """
+    Отправляет статус парсинга через Server-Sent Events при каждом его изменении.
+    Поток закрывается через PARSING_STREAM_LIFETIME секунд, браузер переподключается сам
+    """
+    global PARSING_STREAM_CLIENTS
+    with PARSING_STREAM_CLIENTS_LOCK:
+        if PARSING_STREAM_CLIENTS >= PARSING_STREAM_MAX_CLIENTS:
+            logger.warning("⚠️ Достигнут предел SSE-потоков статуса парсинга")
+            return Response(status=503, headers={'Retry-After': str(PARSING_STREAM_RETRY_MS // 1000)})
+        PARSING_STREAM_CLIENTS += 1
     
-    # Обрабатываем last_completed отдельно, преобразуя все числовые типы
-    if PARSING_STATUS['last_completed']:
-        last_completed = PARSING_STATUS['last_completed'].copy()
-        # Преобразуем все числовые значения в стандартные Python типы
-        if 'timestamp' in last_completed:
-            last_completed['timestamp'] = float(last_completed['timestamp'])
-        if 'parsed_parts' in last_completed:
-            last_completed['parsed_parts'] = int(last_completed['parsed_parts'])
-        if 'found_prices' in last_completed:
-            last_completed['found_prices'] = int(last_completed['found_prices'])
-        status_data['last_completed'] = last_completed
-    else:
-        status_data['last_completed'] = None
+    def release_client():
+        global PARSING_STREAM_CLIENTS
+        with PARSING_STREAM_CLIENTS_LOCK:
+            PARSING_STREAM_CLIENTS -= 1
+    
+    def generate():
+        # Задержка переподключения после закрытия потока сервером
+        yield f"retry: {PARSING_STREAM_RETRY_MS}\n\n".encode()
+        
+        deadline = time.monotonic() + PARSING_STREAM_LIFETIME
+        sent_version = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            with PARSING_STATUS_CHANGED:
+                changed = PARSING_STATUS_CHANGED.wait_for(
+                    lambda: PARSING_STATUS_VERSION != sent_version,
+                    timeout=min(PARSING_STREAM_KEEPALIVE, remaining)
+                )
+                if changed:
+                    sent_version = PARSING_STATUS_VERSION
+                    status_json = PARSING_STATUS_JSON
+            
+            if changed:
+                yield b"data: " + status_json + b"\n\n"
+            elif deadline > time.monotonic():
+                # Комментарий не дает прокси закрыть простаивающее соединение
+                yield b": keep-alive\n\n"
     
-    return jsonify(status_data)
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Место освобождается, когда сервер закрывает ответ: по истечении времени или при отключении клиента
+    response.call_on_close(release_client)
+    return response
 
 @app.route('/analyze-damage', methods=['POST'])
 def analyze_damage_endpoint():
-    global CAR_PRICES_DF
+    """Сохраняет фото и запускает анализ в фоне; результат забирается через /job/<job_id>"""
     try:
-        data = request.get_json()
+        # Фото приходит файлом в multipart/form-data, старые клиенты шлют JSON с base64
+        data = request.get_json(silent=True) or request.form
         
         brand = data.get('brand', '').strip()
         model = data.get('model', '').strip()
-        photo_data = data.get('photo', '')
         
-        print(f"📡 POST /analyze-damage -> {brand} {model}, фото: {'есть' if photo_data else 'нет'}")
+        logger.info(f"📡 POST /analyze-damage -> {brand} {model}")
         
-        # Валидация данных
+        # Сначала дешевые проверки, к фото обращаемся только если запрос можно выполнить
         if not brand or not model:
             return jsonify({
                 "success": False,
                 "error": "Все поля обязательны для заполнения"
             })
         
-        if not photo_data:
-            return jsonify({
-                "success": False,
-                "error": "Фото обязательно для AI анализа повреждений"
-            })
-        
         # Проверяем, загружены ли данные из Excel
+        wait_for_prices_loaded()
         if CAR_PRICES_DF is None:
             return jsonify({
                 "success": False,
                 "error": "База данных не загружена. Убедитесь, что файл huh_result.xlsx существует и имеет правильную структуру."
             })
         
-        # 🔄 ПЕРВЫЙ ЭТАП: ЗАПУСКАЕМ АВТОМАТИЧЕСКИЙ ПАРСИНГ И ЖДЕМ ЕГО ЗАВЕРШЕНИЯ
-        print(f"🚀 Запускаем автоматический парсинг для {brand} {model}")
-        all_parts = get_all_parts_for_model(brand, model)
-        
-        if all_parts:
-            # Запускаем парсинг и ждем его завершения
-            start_auto_parsing(
-                brand=brand,
-                model=model,
-                damaged_parts=all_parts
-            )
-            print(f"⏳ Ожидаем завершения парсинга для {len(all_parts)} деталей...")
-            
-            # Ждем завершения парсинга
-            if not wait_for_parsing_completion():
-                return jsonify({
-                    "success": False,
-                    "error": "Таймаут ожидания обновления данных. Попробуйте позже."
-                })
-            
-            print("✅ Парсинг завершен, продолжаем анализ...")
-        else:
-            print(f"⚠️ Для {brand} {model} не найдено деталей для парсинга")
-        
-        # 🔄 ВТОРОЙ ЭТАП: АНАЛИЗ ФОТО С ОБНОВЛЕННЫМИ ДАННЫМИ
-        # Сохраняем фото
-        photo_path = save_uploaded_photo(photo_data)
-        if not photo_path:
-            return jsonify({
-                "success": False,
-                "error": "Не удалось сохранить фото"
-            })
-        
-        # Запускаем AI анализ повреждений
-        damage_analysis = analyze_damage_with_ai(photo_path, brand, model)
+        # Для демо-фото приходит только его идентификатор
+        demo_id = data.get('demo_photo', '')
+        photo_file = None if demo_id else request.files.get('photo')
+        photo_data = '' if demo_id or photo_file else data.get('photo', '')
         
-        if not damage_analysis:
+        if not demo_id and not photo_file and not photo_data:
             return jsonify({
                 "success": False,
-                "error": "Не удалось проанализировать повреждения на фото. Проверьте скрипт анализа."
+                "error": "Фото обязательно для AI анализа повреждений"
             })
         
-        # 🔄 ПЕРЕЗАГРУЖАЕМ ДАННЫЕ ИЗ EXCEL (чтобы получить актуальные цены)
-        CAR_PRICES_DF = load_repair_prices_from_excel()
-        
-        # Рассчитываем стоимость ремонта и замены на основе анализа
-        damages_with_costs = calculate_repair_cost(damage_analysis, brand, model)
-        
-        if not damages_with_costs:
+        # Сохраняем фото сразу, пока запрос еще держит загруженные данные;
+        # уменьшение фото выполняется уже в задаче анализа
+        if demo_id:
+            photo_path = save_demo_photo(demo_id)
+        elif photo_file:
+            photo_path = save_uploaded_file(photo_file)
+        else:
+            photo_path = save_uploaded_photo(photo_data)
+        if not photo_path:
             return jsonify({
                 "success": False,
-                "error": "Не удалось найти детали для анализа повреждений в таблице"
+                "error": "Не удалось сохранить фото"
             })
         
-        total_repair_cost = sum(damage["repair_cost"] for damage in damages_with_costs)
-        total_replacement_cost = sum(damage["replacement_cost"] for damage in damages_with_costs)
+        job_id = start_analysis_job(brand, model, photo_path)
         
-        response_data = {
+        return jsonify({
             "success": True,
-            "brand": brand,
-            "model": model,
-            "damages": damages_with_costs,
-            "total_repair_cost": int(total_repair_cost),
-            "total_replacement_cost": int(total_replacement_cost),
-            "photo_preview": photo_data,
-            "analysis_method": "AI",
-            "background_parsing": len(all_parts) if all_parts else 0
-        }
-        
-        return jsonify(response_data)
+            "job_id": job_id,
+            "status": "pending",
+            "stage": "parsing"
+        }), 202
         
+    except RequestEntityTooLarge:
+        # Тело без Content-Length оказалось больше лимита - отвечает обработчик 413
+        raise
     except Exception as e:
-        print(f"❌ Ошибка в analyze_damage: {e}")
+        logger.error(f"❌ Ошибка в analyze_damage: {e}")
         return jsonify({
             "success": False,
             "error": f"Внутренняя ошибка сервера: {str(e)}"
         })
 
-if __name__ == '__main__':
-    print("🚀 Запуск системы AI оценки повреждений автомобиля")
-    print(f"🔧 Скрипт анализа: {DAMAGE_ANALYSIS_SCRIPT}")
+@app.route('/job/<job_id>')
+def analysis_job_status(job_id):
+    """Возвращает этап задачи анализа, а после завершения — ее результат"""
+    with ANALYSIS_JOBS_LOCK:
+        job = ANALYSIS_JOBS.get(job_id)
+        if job is None:
+            return jsonify({
+                "success": False,
+                "error": "Задача анализа не найдена или ее результат уже получен"
+            }), 404
+        
+        if job['status'] != 'done':
+            return jsonify({
+                "success": True,
+                "status": job['status'],
+                "stage": job['stage']
+            })
+        
+        # Результат отдается один раз, после этого задача больше не нужна
+        del ANALYSIS_JOBS[job_id]
     
-    if CAR_PRICES_DF is not None:
-        print(f"✅ Успешно загружено {len(CAR_PRICES_DF)} записей из huh_result.xlsx")
-        print("🚗 Доступные марки:", get_unique_brands())
-    else:
-        print("❌ Не удалось загрузить данные из Excel файла")
-        print("📋 Убедитесь, что файл huh_result.xlsx существует со следующими колонками:")
-        print("   - марка, модель, деталь, площадь детали, материал детали, цена, ссылка")
+    logger.info(f"📡 GET /job/{job_id} -> результат готов")
+    return jsonify({**job['result'], "status": "done"})
+
+if __name__ == '__main__':
+    logger.info("🚀 Запуск системы AI оценки повреждений автомобиля")
+    logger.info(f"🔧 Скрипт анализа: {DAMAGE_ANALYSIS_SCRIPT}")
+    logger.info("📊 Таблица цен загружается в фоне...")
     
-    print("📸 Демо-фотографии загружены:")
+    logger.info("📸 Демо-фотографии загружены:")
     for demo_id, photo_info in DEMO_PHOTOS.items():
-        status = "✅" if photo_info['base64'] else "❌"
-        print(f"   {status} {photo_info['name']}")
+        status = "✅" if photo_info['url'] else "❌"
+        logger.info(f"   {status} {photo_info['name']}")
     
-    print("🌐 Сервер запущен: http://localhost:5000")
-    app.run(debug=True, port=5000)
+    logger.info("🌐 Сервер запущен: http://localhost:5000")
+    # Встроенный сервер - только для разработки, в продакшене используется gunicorn (см. Procfile)
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', port=5000, threaded=True)
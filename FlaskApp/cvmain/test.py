@@ -1,8 +1,10 @@
 import cv2
 import numpy as np
 import os
+import sys
 import json
 import argparse
+import contextlib
 from datetime import datetime
 from ultralytics import YOLO
 
@@ -332,7 +334,15 @@ def save_intersection_images(original_image, damage_boxes, damage_labels, part_b
         'final_path': final_path
     }
 
-def analyze_car_damage(image_path, confidence_threshold=0.5):
+# Загруженные модели (повреждения, части) - загружаются один раз на процесс
+_MODELS = None
+
+def load_models():
+    """Загружает модели повреждений и частей автомобиля, повторно использует уже загруженные"""
+    global _MODELS
+    if _MODELS is not None:
+        return _MODELS
+    
     # Получаем пути к моделям
     damage_model_path = get_model_path("pp2/best.pt")
     part_model_path = get_model_path("pp1/best.pt")
@@ -348,49 +358,84 @@ def analyze_car_damage(image_path, confidence_threshold=0.5):
     part_model = YOLO(part_model_path)
     print("✅ Модели загружены успешно")
     
+    _MODELS = (damage_model, part_model)
+    return _MODELS
+
+def analyze_car_damage(image_path, confidence_threshold=0.5):
+    return analyze_car_damage_batch([image_path], confidence_threshold)[0]
+
+def analyze_car_damage_batch(image_paths, confidence_threshold=0.5):
+    """
+    Анализирует несколько фото сразу: каждая модель делает один прогон на весь пакет,
+    что на GPU почти так же быстро, как прогон одного фото.
+    Возвращает для каждого фото пару (matches, saved_paths)
+    """
+    outcomes = [(None, None)] * len(image_paths)
+    
+    damage_model, part_model = load_models()
+    if damage_model is None or part_model is None:
+        return outcomes
+    
     folders = create_output_folders()
-    image_name = os.path.splitext(os.path.basename(image_path))[0]
     
-    print(f"Анализ изображения: {image_path}")
+    images = []
+    loaded = []
+    for i, image_path in enumerate(image_paths):
+        print(f"Анализ изображения: {image_path}")
+        image = cv2.imread(image_path)
+        if image is None:
+            print("Ошибка: не удалось загрузить изображение")
+            continue
+        images.append(image)
+        loaded.append(i)
     print("-" * 50)
     
-    image = cv2.imread(image_path)
-    if image is None:
-        print("Ошибка: не удалось загрузить изображение")
-        return None, None
+    if not images:
+        return outcomes
+    
+    print("Поиск повреждений...")
+    damage_results = damage_model(images, conf=confidence_threshold)
+    print("Определение частей машины...")
+    part_results = part_model(images, conf=confidence_threshold)
     
+    for i, image, damage_result, part_result in zip(loaded, images, damage_results, part_results):
+        outcomes[i] = report_car_damage(
+            image_paths[i], image, damage_result, part_result,
+            damage_model.names, part_model.names, folders
+        )
+    
+    return outcomes
+
+def report_car_damage(image_path, image, damage_result, part_result, damage_names, part_names, folders):
+    """Сопоставляет найденные повреждения с частями машины и сохраняет результаты для одного фото"""
+    image_name = os.path.splitext(os.path.basename(image_path))[0]
     image_dimensions = image.shape  # (height, width, channels)
     
-    print("Поиск повреждений...")
-    damage_results = damage_model(image, conf=confidence_threshold)
+    print(f"Результаты для {image_path}")
     damage_boxes = []
     damage_labels = []
     
-    for result in damage_results:
-        for box in result.boxes:
-            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-            damage_boxes.append([x1, y1, x2, y2])
-            original_damage_label = damage_model.names[int(box.cls[0])]
-            # Преобразуем на русский
-            russian_damage_label = map_damage_to_russian(original_damage_label)
-            damage_labels.append(russian_damage_label)
+    for box in damage_result.boxes:
+        x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
+        damage_boxes.append([x1, y1, x2, y2])
+        original_damage_label = damage_names[int(box.cls[0])]
+        # Преобразуем на русский
+        russian_damage_label = map_damage_to_russian(original_damage_label)
+        damage_labels.append(russian_damage_label)
     
     print(f"Найдено повреждений: {len(damage_boxes)}")
     print("Типы повреждений:", ", ".join(set(damage_labels)))
     
-    print("Определение частей машины...")
-    part_results = part_model(image, conf=confidence_threshold)
     part_boxes = []
     part_labels = []
     
-    for result in part_results:
-        for box in result.boxes:
-            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-            part_boxes.append([x1, y1, x2, y2])
-            original_part_label = part_model.names[int(box.cls[0])]
-            # Преобразуем на русский
-            russian_part_label = map_yolo_part_to_russian(original_part_label)
-            part_labels.append(russian_part_label)
+    for box in part_result.boxes:
+        x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
+        part_boxes.append([x1, y1, x2, y2])
+        original_part_label = part_names[int(box.cls[0])]
+        # Преобразуем на русский
+        russian_part_label = map_yolo_part_to_russian(original_part_label)
+        part_labels.append(russian_part_label)
     
     print(f"Найдено частей машины: {len(part_boxes)}")
     print("Обнаруженные части:", ", ".join(set(part_labels)))
@@ -455,65 +500,110 @@ def analyze_car_damage(image_path, confidence_threshold=0.5):
     
     return matches, saved_paths
 
+def build_result_data(matches, image_path, brand, model):
+    """Формирует результат анализа для веб-интерфейса на русском языке"""
+    if matches is None:
+        return {
+            "error": "Не удалось выполнить анализ повреждений",
+            "damages": []
+        }
+    
+    return {
+        "damages": [
+            {
+                "part": match['part_name'],  # Уже на русском
+                "severity": determine_severity(match['damage_type'], match['iou'], 0.1),  # Автоматическое определение тяжести
+                "confidence": match['iou'],
+                "location": f"Область {match['damage_index'] + 1}",
+                "type": match['damage_type']  # Уже на русском
+            }
+            for match in matches
+        ],
+        "analysis_info": {
+            "total_damages": len(matches),
+            "image_path": image_path,
+            "brand": brand,
+            "model": model,
+            "analysis_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+    }
+
+def analyze(image_path, brand, model, confidence=0.5):
+    """
+    Анализирует фото и возвращает результат для веб-интерфейса.
+    Вызывается приложением напрямую, модели при этом загружаются один раз
+    """
+    return analyze_batch([(image_path, brand, model)], confidence)[0]
+
+def analyze_batch(requests, confidence=0.5):
+    """
+    Анализирует пакет фото одним прогоном моделей.
+    requests - список (image_path, brand, model), результаты возвращаются в том же порядке
+    """
+    results = [None] * len(requests)
+    existing = []
+    
+    for i, (image_path, brand, model) in enumerate(requests):
+        # Проверяем существование изображения
+        if not os.path.exists(image_path):
+            print(f"❌ Файл изображения не найден: {image_path}")
+            results[i] = {
+                "error": f"Файл изображения не найден: {image_path}",
+                "damages": []
+            }
+        else:
+            existing.append(i)
+    
+    if existing:
+        outcomes = analyze_car_damage_batch([requests[i][0] for i in existing], confidence)
+        for i, (matches, saved_paths) in zip(existing, outcomes):
+            image_path, brand, model = requests[i]
+            results[i] = build_result_data(matches, image_path, brand, model)
+    
+    return results
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    """
+    Перенаправляет дескриптор stdout в stderr и возвращает копию исходного stdout для результата.
+    redirect_stdout здесь не подходит: логгер ultralytics держит исходный sys.stdout и пишет в дескриптор 1
+    """
+    sys.stdout.flush()
+    result_fd = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        yield result_fd
+    finally:
+        sys.stdout.flush()
+        os.dup2(result_fd, 1)
+
 def main():
     parser = argparse.ArgumentParser(description='Анализ повреждений автомобиля')
     parser.add_argument('--image', required=True, help='Путь к изображению')
     parser.add_argument('--brand', required=True, help='Марка автомобиля')
     parser.add_argument('--model', required=True, help='Модель автомобиля')
-    parser.add_argument('--output', required=True, help='Путь для сохранения результатов JSON')
+    parser.add_argument('--output', default='-', help='Путь для сохранения результатов JSON ("-" - в stdout)')
     parser.add_argument('--confidence', type=float, default=0.5, help='Порог уверенности для детекции')
     
     args = parser.parse_args()
+    to_stdout = args.output == '-'
+    
+    # При выводе результата в stdout сообщения о ходе анализа уходят в stderr
+    with stdout_to_stderr() if to_stdout else contextlib.nullcontext() as result_stream:
+        print("🚗 Запуск анализа повреждений автомобиля")
+        print(f"📁 Изображение: {args.image}")
+        print(f"🚙 Марка: {args.brand}")
+        print(f"🚗 Модель: {args.model}")
+        print(f"🎯 Уверенность: {args.confidence}")
+        print("-" * 50)
+        
+        result_data = analyze(args.image, args.brand, args.model, args.confidence)
     
-    print("🚗 Запуск анализа повреждений автомобиля")
-    print(f"📁 Изображение: {args.image}")
-    print(f"🚙 Марка: {args.brand}")
-    print(f"🚗 Модель: {args.model}")
-    print(f"🎯 Уверенность: {args.confidence}")
-    print("-" * 50)
-    
-    # Проверяем существование изображения
-    if not os.path.exists(args.image):
-        print(f"❌ Файл изображения не найден: {args.image}")
-        # Сохраняем ошибку в выходной файл
-        error_result = {
-            "error": f"Файл изображения не найден: {args.image}",
-            "damages": []
-        }
-        with open(args.output, 'w', encoding='utf-8') as f:
-            json.dump(error_result, f, ensure_ascii=False, indent=2)
+    if to_stdout:
+        with os.fdopen(result_stream, 'w', encoding='utf-8') as f:
+            json.dump(result_data, f, ensure_ascii=False)
         return
     
-    # Запускаем анализ
-    matches, saved_paths = analyze_car_damage(args.image, args.confidence)
-    
-    # Формируем результат для веб-интерфейса на русском языке
-    if matches is not None:
-        result_data = {
-            "damages": [
-                {
-                    "part": match['part_name'],  # Уже на русском
-                    "severity": determine_severity(match['damage_type'], match['iou'], 0.1),  # Автоматическое определение тяжести
-                    "confidence": match['iou'],
-                    "location": f"Область {match['damage_index'] + 1}",
-                    "type": match['damage_type']  # Уже на русском
-                }
-                for match in matches
-            ],
-            "analysis_info": {
-                "total_damages": len(matches),
-                "image_path": args.image,
-                "brand": args.brand,
-                "model": args.model,
-                "analysis_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-        }
-    else:
-        result_data = {
-            "error": "Не удалось выполнить анализ повреждений",
-            "damages": []
-        }
-    
     # Сохраняем результат в указанный файл
     with open(args.output, 'w', encoding='utf-8') as f:
         json.dump(result_data, f, ensure_ascii=False, indent=2)
@@ -1,5 +1,7 @@
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 import time
 import random
@@ -10,6 +12,13 @@ import os
 from threading import Thread
 import json
 
+# Движок чтения Excel: calamine заметно быстрее openpyxl, если установлен
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None  # движок pandas по умолчанию (openpyxl)
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -20,17 +29,35 @@ logging.basicConfig(
     ]
 )
 
+def create_session():
+    """
+    Создает HTTP-сессию для парсинга: соединения с сайтом переиспользуются между
+    запросами и запусками парсера, временные ошибки сервера повторяются
+    """
+    session = requests.Session()
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+        'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1',
+    })
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 502, 503, 504))
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Общая сессия для всех запусков парсера
+SESSION = create_session()
+
 class AutoDromParser:
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        })
+    def __init__(self, session=None):
+        self.session = session or SESSION
         self.base_url = "https://baza.drom.ru"
 
     def search_part(self, brand, model, part):
@@ -268,7 +295,7 @@ def update_excel_with_parsed_data(parsed_df, excel_file='huh_result.xlsx'):
     try:
         if os.path.exists(excel_file):
             # Загружаем существующий файл
-            existing_df = pd.read_excel(excel_file)
+            existing_df = pd.read_excel(excel_file, engine=EXCEL_ENGINE)
             
             # Обновляем или добавляем данные
             for _, new_row in parsed_df.iterrows():
@@ -0,0 +1,25 @@
+// Уменьшение фото перед отправкой вне основного потока страницы.
+// Получает {id, file, maxSide, quality}, отвечает {id, blob, width, height} или {id, error}
+self.onmessage = async function(event) {
+    const { id, file, maxSide, quality } = event.data;
+    try {
+        const bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' });
+        const scale = Math.min(1, maxSide / Math.max(bitmap.width, bitmap.height));
+        if (scale === 1 && file.type === 'image/jpeg') {
+            bitmap.close();
+            self.postMessage({ id, blob: file });
+            return;
+        }
+
+        const width = Math.round(bitmap.width * scale);
+        const height = Math.round(bitmap.height * scale);
+        const canvas = new OffscreenCanvas(width, height);
+        canvas.getContext('2d').drawImage(bitmap, 0, 0, width, height);
+        bitmap.close();
+
+        const blob = await canvas.convertToBlob({ type: 'image/jpeg', quality: quality });
+        self.postMessage({ id, blob, width, height });
+    } catch (error) {
+        self.postMessage({ id, error: String(error) });
+    }
+};
@@ -0,0 +1,23 @@
+# Настройки gunicorn для продакшена; gunicorn читает этот файл сам при запуске из корня проекта:
+#   gunicorn app8:app
+import os
+
+chdir = 'FlaskApp'
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Процесс-воркер один: задачи анализа, статус парсинга и таблица цен хранятся в памяти процесса,
+# и опрос /job/<job_id> должен попадать в тот же процесс. Параллельность дают потоки
+worker_class = 'gthread'
+workers = 1
+# Каждый открытый поток /parsing-status/stream занимает поток воркера. Их не больше
+# PARSING_STREAM_MAX_CLIENTS (8, см. app8.py), остальные потоки - для обычных запросов
+sse_threads = 8
+request_threads = 16
+threads = sse_threads + request_threads
+
+# Соединения браузера переиспользуются между запросами страницы и опросами задачи
+keepalive = 30
+
+# Приложение загружается в самом воркере: при загрузке запускаются фоновые потоки
+# (логи, чтение таблицы цен, анализ), которые не переживают fork из мастер-процесса
+preload_app = False